@@ -1,11 +1,22 @@
-from fastapi import FastAPI, BackgroundTasks
-from fastapi.responses import FileResponse
+import functools
+import time
+
+from fastapi import FastAPI, BackgroundTasks, Request
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
 from db.create_db import init_db, DB_PATH
 from pathlib import Path
-from src.downloader import FotoladuDownloader, SearchParams
+from src.downloader import BBoxParams, FotoladuDownloader, SearchParams
 from src.image_loader import ImageLoader
+from src.flight_index import FlightIndex
+from src.image_hash import DuplicateIndex, DHASH_MAX_DISTANCE, PHASH_MAX_DISTANCE
+from src import metrics
+from src.exporter import FORMATS, MetadataExporter
+from src.region_crawler import RESULT_CAP, RegionCrawler
+from src.tiles import TilePyramid, TileSourceError, VARIANTS
+from src.label_queue import LabelQueue, LeaseConflict
+from pydantic import BaseModel
 
 STATIC_DIR = Path("static")
 DATA_DIR = Path("data")
@@ -15,13 +26,80 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 app.mount("/data", StaticFiles(directory=DATA_DIR), name="data")
 downloader = None
 imgloader = None
+flight_index = None
+duplicate_index = None
+tiles = None
+label_queue = None
+
+_MOUNTS = ("/static", "/data")
+
+HTTP_SECONDS = metrics.histogram(
+    "http_request_duration_seconds", "API latency per endpoint", ("method", "endpoint", "status")
+)
+BACKGROUND_QUEUE = metrics.gauge("background_tasks_queued", "Background tasks queued or running")
+
+
+def _endpoint_label(request: Request) -> str:
+    """Route template (``/api/predict/{image_id}``) to keep label cardinality low."""
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    # Mounted apps have no route; anything else is a 404 and gets one fixed
+    # label, so scanned paths cannot create new series.
+    segment = "/" + request.url.path.lstrip("/").split("/", 1)[0]
+    return segment if segment in _MOUNTS else "<unmatched>"
+
+
+def _tracked(fn):
+    """Wrap a background task so the queue-depth gauge follows it."""
+    BACKGROUND_QUEUE.inc()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            BACKGROUND_QUEUE.dec()
+
+    return run
+
+
+# Tiles of an (image, variant) pyramid never change once built.
+_TILE_CACHE_CONTROL = "public, max-age=2592000, immutable"
+
+
+def _cached_file(request: Request, path: Path, media_type: str) -> Response:
+    """FileResponse with ETag/Cache-Control that answers If-None-Match with 304."""
+    stat = path.stat()
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": _TILE_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            endpoint=_endpoint_label(request),
+            status=status,
+        )
 
 
 @app.on_event("startup")
 async def startup() -> None:
-    if not DB_PATH.exists():
-        init_db(DB_PATH)
-        print("Created DB")
+    # init.sql only uses IF NOT EXISTS, so re-running it on every start adds
+    # tables and indexes introduced after the DB was first created.
+    init_db(DB_PATH)
     global downloader
     if not downloader:
         downloader = FotoladuDownloader(db_path=DB_PATH)
@@ -30,6 +108,25 @@ async def startup() -> None:
     if not imgloader:
         imgloader = ImageLoader(db_path=DB_PATH)
         print("ImageLoader init")
+    global flight_index
+    if not flight_index:
+        flight_index = FlightIndex(db_path=DB_PATH)
+        # Backfill flight_frame for images ingested before it existed; new
+        # images get their row at ingest, so GET requests stay read-only.
+        flight_index.sync()
+        print("FlightIndex init")
+    global duplicate_index
+    if not duplicate_index:
+        duplicate_index = DuplicateIndex(db_path=DB_PATH)
+        print("DuplicateIndex init")
+    global tiles
+    if not tiles:
+        tiles = TilePyramid(db_path=DB_PATH, downloader=downloader)
+        print("TilePyramid init")
+    global label_queue
+    if not label_queue:
+        label_queue = LabelQueue(db_path=DB_PATH)
+        print("LabelQueue init")
 
 
 @app.get("/")
@@ -37,6 +134,12 @@ def read_index():
     return FileResponse(STATIC_DIR / "index.html")
 
 
+@app.get("/metrics")
+def read_metrics():
+    """Prometheus text exposition of the in-process metrics."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/random")
 def random_image(count: int | None = 5):
     """Return placeholder random image data."""
@@ -48,26 +151,175 @@ def random_image(count: int | None = 5):
         raise err
 
 
+class TagSubmission(BaseModel):
+    image_id: int
+    tags: dict[str, bool | None]
+
+
+@app.post("/api/session")
+def open_session():
+    """Start a labeling session; frames are leased per session."""
+    return {"session": label_queue.new_session(), "lease_seconds": label_queue.lease_seconds}
+
+
+@app.post("/api/session/{session}/lease")
+def lease_images(session: str, count: int = 5):
+    """Lease `count` untagged frames (URLs resolved) and renew open leases."""
+    return label_queue.lease(session, n=count)
+
+
+@app.post("/api/session/{session}/tags")
+def submit_tags(session: str, submission: TagSubmission):
+    """Store tags for a leased frame and close its lease."""
+    try:
+        label_queue.submit(session, submission.image_id, submission.tags)
+    except LeaseConflict as err:
+        return {"error": str(err)}
+    return {"status": "stored", "image_id": submission.image_id}
+
+
+@app.post("/api/session/{session}/release")
+def release_session(session: str):
+    """Return all frames still leased by the session to the pool."""
+    return {"released": label_queue.release(session)}
+
+
+@app.get("/api/predict/{image_id}")
+def predict_location(image_id: int):
+    """Predict frame position from georeferenced frames of the same flight."""
+    if image_id not in flight_index:
+        return {"error": "unknown image or frame without flight/frame number"}
+    prediction = flight_index.predict(image_id)
+    if prediction is None:
+        return {"error": "no georeferenced frames in this flight"}
+    return prediction
+
+
+@app.get("/api/duplicates")
+def duplicate_clusters(
+    dhash_distance: int = DHASH_MAX_DISTANCE,
+    phash_distance: int = PHASH_MAX_DISTANCE,
+):
+    """List clusters of near-duplicate frames (same negative, other folder)."""
+    clusters = duplicate_index.clusters(
+        dhash_distance=dhash_distance, phash_distance=phash_distance
+    )
+    return {"count": len(clusters), "clusters": clusters}
+
+
+@app.get("/api/tiles/{image_id}/{variant}.dzi")
+def tile_descriptor(image_id: int, variant: str):
+    """DeepZoom descriptor; builds the pyramid on first access."""
+    if variant not in VARIANTS:
+        return {"error": f"variant must be one of {', '.join(VARIANTS)}"}
+    try:
+        dzi = tiles.descriptor(image_id, variant)
+    except TileSourceError as err:
+        return {"error": str(err)}
+    if dzi is None:
+        return {"error": "unknown image"}
+    return Response(dzi, media_type="application/xml", headers={"Cache-Control": _TILE_CACHE_CONTROL})
+
+
+@app.get("/api/tiles/{image_id}/{variant}_files/{level}/{col}_{row}.jpg")
+def tile_image(request: Request, image_id: int, variant: str, level: int, col: int, row: int):
+    """Single DeepZoom tile, relative to the `.dzi` URL as viewers expect."""
+    if variant not in VARIANTS:
+        return Response(status_code=404)
+    try:
+        path = tiles.tile(image_id, variant, level, col, row)
+        if path is None:
+            return Response(status_code=404)
+        return _cached_file(request, path, "image/jpeg")
+    except (TileSourceError, FileNotFoundError):
+        # Source variant unavailable, or pyramid evicted since the lookup.
+        return Response(status_code=404)
+
+
+@app.get("/api/export")
+def export_metadata(
+    format: str = "ndjson",
+    after_id: int = 0,
+    limit: int | None = None,
+    aasta: str | None = None,
+    peakaust: str | None = None,
+    kaust: str | None = None,
+    lend: str | None = None,
+    tag: str | None = None,
+    georeferenced: bool | None = None,
+):
+    """Stream image metadata with location and tags as NDJSON, CSV or Parquet.
+
+    Rows are ordered by `id`; resume an interrupted export with
+    `after_id=<last id received>`.
+    """
+    if format not in FORMATS:
+        return {"error": f"format must be one of {', '.join(FORMATS)}"}
+    body = MetadataExporter(db_path=DB_PATH).stream(
+        format,
+        after_id=after_id,
+        limit=limit,
+        tag=tag,
+        georeferenced=georeferenced,
+        aasta=aasta,
+        peakaust=peakaust,
+        kaust=kaust,
+        lend=lend,
+    )
+    return StreamingResponse(
+        body,
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="fotoladu-export.{format}"'},
+    )
+
+
 @app.post("/api/download")
 async def api_download(
     background_tasks: BackgroundTasks,
     nr: int | None = None,
     kaust: str | None = None,
+    full: bool = False,
 ):
     """
     Trigger image download in a background task.
 
     Queue a download task for every image whose *photo sequence number*
     matches `nr` (same as typing it into Fotoladu's "Foto nr" field).
+    A `kaust` sync is incremental unless `full` is set.
     """
     pages = 50
     if kaust:
-        background_tasks.add_task(downloader.download_by_kaust, kaust, max_pages=pages)
+        background_tasks.add_task(_tracked(downloader.download_by_kaust), kaust, max_pages=pages, full=full)
         return {"status": "started", "kaust": kaust}
 
     if nr is not None:
         params = SearchParams(foto_nr=nr, lkcount=60)
-        background_tasks.add_task(downloader.download_via_search, params)
+        background_tasks.add_task(_tracked(downloader.download_via_search), params)
         return {"status": "started", "nr": nr}
 
     return {"error": "specify either nr or kaust"}
+
+
+@app.post("/api/crawl")
+async def api_crawl(
+    background_tasks: BackgroundTasks,
+    a_lat: float,
+    a_lng: float,
+    u_lat: float,
+    u_lng: float,
+    aasta: str = "",
+    result_cap: int = RESULT_CAP,
+    restart: bool = False,
+):
+    """
+    Crawl a bounding box as an adaptive quadtree in a background task.
+
+    Re-posting the same box resumes an interrupted crawl; `restart` crawls a
+    finished box again.  Tiles with `result_cap` or more features are split.
+    """
+    if result_cap < 1:
+        return {"error": "result_cap must be positive"}
+    box = BBoxParams(aasta=aasta, a_lat=a_lat, a_lng=a_lng, u_lat=u_lat, u_lng=u_lng)
+    crawler = RegionCrawler(downloader, result_cap=result_cap)
+    background_tasks.add_task(_tracked(crawler.crawl), box, restart=restart)
+    return {"status": "started", "crawl": RegionCrawler.crawl_id(box)}
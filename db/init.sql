@@ -38,3 +38,87 @@ CREATE TABLE IF NOT EXISTS tag (
     state INTEGER,
     FOREIGN KEY(image_id) REFERENCES image(id)
 );
+
+-- Relative placement of neighbouring frames in a flight, estimated from
+-- keypoint matches. dx/dy is the offset (px) of image_a's centre in image_b,
+-- homography is a JSON array of 9 floats (row-major 3x3).
+CREATE TABLE IF NOT EXISTS frame_match (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_a INTEGER NOT NULL,
+    image_b INTEGER NOT NULL,
+    detector TEXT NOT NULL,
+    matches INTEGER,
+    inliers INTEGER,
+    dx REAL,
+    dy REAL,
+    homography TEXT,
+    FOREIGN KEY(image_a) REFERENCES image(id),
+    FOREIGN KEY(image_b) REFERENCES image(id),
+    UNIQUE(image_a, image_b, detector)
+);
+
+-- Normalised flight sequence: flight is "<aasta>:<lend without separators>",
+-- flight_no/frame_no are the numeric parts of lend/fotonr.
+CREATE TABLE IF NOT EXISTS flight_frame (
+    image_id INTEGER PRIMARY KEY,
+    flight TEXT NOT NULL,
+    flight_no INTEGER,
+    frame_no INTEGER,
+    FOREIGN KEY(image_id) REFERENCES image(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_flight_frame_seq ON flight_frame(flight, frame_no);
+CREATE INDEX IF NOT EXISTS idx_location_image ON location(image_id);
+
+-- 64-bit perceptual hashes of the thumbs variant (stored as signed INTEGER).
+CREATE TABLE IF NOT EXISTS image_hash (
+    image_id INTEGER PRIMARY KEY,
+    dhash INTEGER NOT NULL,
+    phash INTEGER NOT NULL,
+    FOREIGN KEY(image_id) REFERENCES image(id)
+);
+
+-- Watermarks for incremental download_by_kaust syncs. last_total stays NULL
+-- until every frame of the folder is stored.
+CREATE TABLE IF NOT EXISTS kaust_sync (
+    kaust TEXT PRIMARY KEY,
+    last_total INTEGER,
+    max_fotoladu_id INTEGER,
+    page_fingerprint TEXT,
+    synced_at TEXT
+);
+
+-- Stored-frame counts per folder for the kaust_sync completeness check.
+CREATE INDEX IF NOT EXISTS idx_image_kaust ON image(kaust);
+
+-- Frames a sync deliberately did not store (reason: duplicate or missing,
+-- i.e. 404 upstream); they count towards kaust_sync completeness.
+CREATE TABLE IF NOT EXISTS skipped_frame (
+    fotoladu_id INTEGER PRIMARY KEY,
+    kaust TEXT,
+    reason TEXT NOT NULL,
+    skipped_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_skipped_frame_kaust ON skipped_frame(kaust);
+
+CREATE INDEX IF NOT EXISTS idx_tag_image ON tag(image_id);
+
+-- Quadtree tiles of RegionCrawler runs; status is pending, split or done.
+CREATE TABLE IF NOT EXISTS crawl_tile (
+    crawl TEXT NOT NULL,
+    quadkey TEXT NOT NULL,
+    status TEXT NOT NULL,
+    features INTEGER,
+    PRIMARY KEY (crawl, quadkey)
+);
+
+-- Frames handed out to labeling sessions; expired rows return to the pool.
+CREATE TABLE IF NOT EXISTS label_lease (
+    image_id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    FOREIGN KEY(image_id) REFERENCES image(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_label_lease_session ON label_lease(session);
@@ -1,5 +1,7 @@
 import sys
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Add project root to sys.path to make imports work
@@ -7,8 +9,8 @@ from pathlib import Path
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
-from db.create_db import DB_PATH
-from src.downloader import FotoladuDownloader
+from db.create_db import init_db, DB_PATH
+from src.downloader import UPSTREAM, FotoladuDownloader
 
 # 3) Configure logging with timestamps
 # Format: 2025-06-01 12:34:56 INFO: Your message here
@@ -20,11 +22,42 @@ logging.basicConfig(
 logger = logging.getLogger("__name__")
 
 DEFAULT_PAGES = 50
+# Do not ingest frames that are perceptual-hash duplicates of stored ones
+# (e.g. the same negative under ma_neg and ma_neg_ngr). Each frame is
+# committed on its own and every check re-reads new hashes, so workers see
+# what the others stored.
+SKIP_DUPLICATES = True
+# Folders synced in parallel. Upstream politeness is handled by the shared
+# rate controller in src.downloader, not by this number.
+WORKERS = 4
+
+_local = threading.local()
+
+
+def _downloader() -> FotoladuDownloader:
+    # One downloader (and SQLite connection) per worker thread; the upstream
+    # rate limit is shared by all of them.
+    if not hasattr(_local, "dl"):
+        _local.dl = FotoladuDownloader(db_path=DB_PATH, skip_duplicates=SKIP_DUPLICATES)
+    return _local.dl
+
+
+def _sync(idx: int, total: int, kaust_name: str) -> None:
+    logger.info(f"[{idx}/{total}] Starting download for folder: {kaust_name!r}")
+    try:
+        changed = _downloader().download_by_kaust(kaust_name, max_pages=DEFAULT_PAGES)
+        logger.info(f"[{idx}/{total}] Completed folder: {kaust_name!r}" + ("" if changed else " (unchanged)"))
+    except Exception as e:
+        logger.exception(
+            f"[{idx}/{total}] Error processing folder {kaust_name!r}: {e}"
+        )
 
 
 def main() -> None:
-    # Initialize downloader once, pointing at the same DB_PATH used elsewhere
-    dl = FotoladuDownloader(db_path=DB_PATH)
+    init_db(DB_PATH)
+    # Sleep through an open circuit breaker instead of failing every
+    # remaining folder within milliseconds.
+    UPSTREAM.wait_when_open = True
     raw_dir = Path("data/raw")
 
     # ① Gather all subdirectories that are at the `kaust` level.
@@ -33,18 +66,11 @@ def main() -> None:
     total = len(folders)
     logger.info(f"Found {total} folders in `{raw_dir}` to process.")
 
-    # ② Iterate and download by 'kaust'
+    # ② Sync folders concurrently by 'kaust'
     offset = 0
-    for idx, folder in enumerate(folders[offset:], start=offset + 1):
-        kaust_name = folder.name
-        logger.info(f"[{idx}/{total}] Starting download for folder: {kaust_name!r}")
-        try:
-            dl.download_by_kaust(kaust_name, max_pages=DEFAULT_PAGES)
-            logger.info(f"[{idx}/{total}] Completed folder: {kaust_name!r}")
-        except Exception as e:
-            logger.exception(
-                f"[{idx}/{total}] Error processing folder {kaust_name!r}: {e}"
-            )
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for idx, folder in enumerate(folders[offset:], start=offset + 1):
+            pool.submit(_sync, idx, total, folder.name)
     logger.info("All directories processed. Exiting.")
 
 
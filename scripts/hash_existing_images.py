@@ -0,0 +1,59 @@
+import sys
+import logging
+import sqlite3
+from pathlib import Path
+
+# Add project root to sys.path to make imports work
+# This is temporary change.
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from db.create_db import init_db, DB_PATH
+from src.image_hash import hash_file, to_signed
+
+# Backfills image_hash for frames ingested before hashing was added.
+# New downloads are hashed by FotoladuDownloader at ingest time.
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s: %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+
+BATCH = 500
+
+
+def _thumb_for(path: Path) -> Path:
+    """data/raw/<peakaust>/<kaust>/<variant>/<fail> -> same file under thumbs."""
+    thumb = path.parent.parent / "thumbs" / path.name
+    return thumb if thumb.exists() else path
+
+
+def main() -> None:
+    init_db(DB_PATH)
+    with sqlite3.connect(DB_PATH) as conn:
+        rows = conn.execute(
+            "SELECT id, path FROM image WHERE id NOT IN (SELECT image_id FROM image_hash)"
+        ).fetchall()
+        logger.info(f"{len(rows)} images without hashes")
+        done = 0
+        for idx, (image_id, path) in enumerate(rows, start=1):
+            hashes = hash_file(_thumb_for(Path(path)))
+            if hashes is None:
+                logger.warning(f"Cannot read {path}")
+                continue
+            conn.execute(
+                "INSERT OR IGNORE INTO image_hash (image_id, dhash, phash) VALUES (?,?,?)",
+                (image_id, to_signed(hashes[0]), to_signed(hashes[1])),
+            )
+            done += 1
+            if idx % BATCH == 0:
+                conn.commit()
+                logger.info(f"[{idx}/{len(rows)}] hashed")
+        conn.commit()
+    logger.info(f"Done, hashed {done} images")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import sys
+import logging
+from pathlib import Path
+
+# Add project root to sys.path to make imports work
+# This is temporary change.
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from db.create_db import init_db, DB_PATH
+from src.feature_matching import DescriptorStore, FlightMatcher
+
+# Matches overlapping neighbour frames of every downloaded flight.
+# Descriptors are cached in data/features, so re-runs only extract new frames.
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s: %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+
+DETECTOR = "orb"
+
+
+def main(resume_from: int = 1) -> None:
+    # Schema script is idempotent, makes sure frame_match exists on older DBs.
+    init_db(DB_PATH)
+    # One matcher for the whole run, so its worker pool is started only once.
+    with FlightMatcher(db_path=DB_PATH, store=DescriptorStore(detector=DETECTOR)) as matcher:
+        kausts = matcher.kausts()
+        for idx, kaust in enumerate(kausts, start=1):
+            if idx < resume_from:
+                continue
+            logger.info(f"[{idx}/{len(kausts)}] Matching {kaust}")
+            try:
+                matcher.match_flight(kaust)
+            except Exception as e:
+                logger.exception(f"[{idx}/{len(kausts)}] Error matching {kaust!r}: {e}")
+    logger.info("Done")
+
+
+if __name__ == "__main__":
+    main()
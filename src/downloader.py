@@ -20,6 +20,7 @@ dl.ingest_bbox(box)
 ```
 """
 
+import hashlib
 import re
 import sqlite3
 from pathlib import Path
@@ -28,6 +29,10 @@ from typing import Any, Dict, List, Optional
 import requests
 import logging
 from db.create_db import init_db
+from src import metrics
+from src.rate_control import UpstreamController
+from src.flight_index import INSERT_FLIGHT_FRAME, flight_frame_row
+from src.image_hash import DuplicateIndex, hash_file, to_signed
 from pydantic import BaseModel, Field, validator
 
 __all__ = [
@@ -48,6 +53,31 @@ BBOX_URL = f"{BASE_URL}/paring_db_arhiiv.php"
 NEAREST_URL = f"{BASE_URL}/paring_closest_arhiiv.php"
 IMAGE_URL = f"{BASE_URL}/data/archive/arhiiv"
 
+_ENDPOINT_NAMES = {SEARCH_URL: "search", BBOX_URL: "bbox", NEAREST_URL: "nearest"}
+
+# Every upstream call in the process shares this budget (see rate_control).
+UPSTREAM = UpstreamController()
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+DOWNLOADED_BYTES = metrics.counter(
+    "fotoladu_downloaded_bytes_total", "Image bytes downloaded from Fotoladu", ("variant",)
+)
+DOWNLOADED_IMAGES = metrics.counter(
+    "fotoladu_downloaded_images_total", "Image files downloaded from Fotoladu", ("variant",)
+)
+IMAGE_CACHE = metrics.counter(
+    "fotoladu_image_cache_total", "Image file lookups, hit = already on disk", ("result",)
+)
+SYNC_RESULTS = metrics.counter(
+    "fotoladu_kaust_sync_total", "download_by_kaust outcomes", ("result",)
+)
+INGESTED_ROWS = metrics.counter(
+    "fotoladu_ingested_rows_total", "Metadata rows passed to the DB", ("outcome",)
+)
+
 # ---------------------------------------------------------------------------
 # Pydantic query models
 # ---------------------------------------------------------------------------
@@ -118,7 +148,7 @@ _KUVA_PATTERN = re.compile(r"kuvapiltfuncarhiiv\(([^)]*)\)")
 
 
 def _http_get(url: str, params: Dict[str, Any] | None = None, *, json: bool = False):
-    resp = requests.get(url, params=params, timeout=30)
+    resp = UPSTREAM.get(url, endpoint=_ENDPOINT_NAMES.get(url, "other"), params=params, timeout=30)
     resp.raise_for_status()
     return resp.json() if json else resp.text
 
@@ -134,6 +164,34 @@ def _parse_search_html(html: str) -> List[Dict[str, Any]]:
     return [_parse_kuva_args(m.group(1)) for m in _KUVA_PATTERN.finditer(html)]
 
 
+def _page_fingerprint(entries: List[Dict[str, Any]]) -> str:
+    """Order-independent hash of the ids on a result page."""
+    ids = sorted(str(e.get("id")) for e in entries)
+    return hashlib.sha1(",".join(ids).encode()).hexdigest()
+
+
+def _feature_meta(feature: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalise a ``paring_db_arhiiv.php`` GeoJSON feature to ``_KUVA_KEYS``.
+
+    The payload names the frame id ``idnr`` and may carry the position only in
+    the point geometry (``[lon, lat]``).
+    """
+    meta = dict(feature.get("properties") or {})
+    if meta.get("id") is None:
+        meta["id"] = meta.get("idnr")
+    try:
+        meta["id"] = int(meta["id"])
+    except (TypeError, ValueError):
+        pass
+    coords = (feature.get("geometry") or {}).get("coordinates") or []
+    if len(coords) >= 2:
+        if meta.get("B") is None:
+            meta["B"] = coords[1]
+        if meta.get("L") is None:
+            meta["L"] = coords[0]
+    return meta
+
+
 def _parse_search_meta(html: str) -> Dict[str, int]:
     """Extract pagination metadata from the search HTML."""
 
@@ -164,13 +222,21 @@ class FotoladuDownloader:
         db_path: Path | str,
         base_path: Path | str = Path("data/raw"),
         variant: str = "reduced",
+        skip_duplicates: bool = False,
     ) -> None:
-        """Create the downloader, preparing paths and DB connection."""
+        """Create the downloader, preparing paths and DB connection.
+
+        With ``skip_duplicates`` a frame whose thumbnail hashes match an
+        already stored frame (see ``src.image_hash``) is neither downloaded in
+        the main variant nor inserted.
+        """
         self.db_path = Path(db_path)
         self.base_path = Path(base_path)
         self.variant = variant
+        self.skip_duplicates = skip_duplicates
         self.base_path.mkdir(parents=True, exist_ok=True)
         self._conn: sqlite3.Connection | None = None
+        self._duplicates: DuplicateIndex | None = None
         # init_db()
 
     # ------------------------------------------------------------------
@@ -180,14 +246,15 @@ class FotoladuDownloader:
     def _get_conn(self) -> sqlite3.Connection:
         """Return an open SQLite connection, creating it if needed."""
         if self._conn is None:
-            self._conn = sqlite3.connect(self.db_path)
+            # Generous busy timeout: several downloaders may write concurrently.
+            self._conn = sqlite3.connect(self.db_path, timeout=30)
             self._conn.execute("PRAGMA journal_mode=WAL")
             self._conn.execute("PRAGMA synchronous=NORMAL")
         else:
             try:
                 self._conn.execute("SELECT 1")
             except sqlite3.ProgrammingError:
-                self._conn = sqlite3.connect(self.db_path)
+                self._conn = sqlite3.connect(self.db_path, timeout=30)
                 self._conn.execute("PRAGMA journal_mode=WAL")
                 self._conn.execute("PRAGMA synchronous=NORMAL")
         return self._conn
@@ -228,30 +295,67 @@ class FotoladuDownloader:
         if isinstance(params, int):
             params = SearchParams(foto_nr=params)
         print(params)
-        html = self._query_search(params)
-        entries = _parse_search_html(html)
-        # print(entries)
-        meta = _parse_search_meta(html)
-        self._bulk_ingest(entries)
-
-        page_size = meta.get("rows", 0) * meta.get("limit", 0)
-        if not page_size:
-            page_size = len(entries)
-        total_pages = meta.get("pages") or 1
-        if meta.get("total") and page_size:
-            total_pages = max(total_pages, (meta["total"] + page_size - 1) // page_size)
-
-        for page in range(1, min(total_pages, max_pages)):
-            params.start = page * page_size
-            html = self._query_search(params)
-            entries = _parse_search_html(html)
-            self._bulk_ingest(entries)
-        logging.info(f"Processed {min(total_pages, max_pages)} pages, with approx {page_size * min(total_pages, max_pages)} records")
-
-    def download_by_kaust(self, kaust: str, *, max_pages: int = 50) -> None:
-        """Download all images belonging to a Fotoladu directory."""
+        self._crawl_search(params, max_pages=max_pages)
+
+    def download_by_kaust(self, kaust: str, *, max_pages: int = 50, full: bool = False) -> bool:
+        """Download all images belonging to a Fotoladu directory.
+
+        The sync is incremental.  ``kaust_sync`` remembers the upstream total
+        once every frame of the folder is accounted for, the highest
+        fotoladu_id seen and a fingerprint of the first result page.  A frame
+        is accounted for when it is stored in ``image`` or recorded in
+        ``skipped_frame`` (skipped duplicate, file missing upstream).  If total
+        and fingerprint are unchanged and that many frames are accounted for,
+        the folder is done after a single search request.  Otherwise pages are walked until
+        one contains only known ids, none above the stored highest id.  If the
+        folder is still incomplete after that (new frames further back, an
+        earlier run cut off by ``max_pages``) every page is walked.  The first
+        sync of a folder and ``full=True`` walk every page; ``full`` also
+        re-ingests known frames and retries skipped ones.  Returns ``False`` if nothing changed.
+        """
         params = SearchParams(sailiku_nr=kaust, lkcount=60)
-        self.download_via_search(params, max_pages=max_pages)
+        conn = self._get_conn()
+        state = conn.execute(self._SELECT_SYNC, (kaust,)).fetchone()
+        last_total, last_max_id, last_fingerprint = state or (None, None, None)
+
+        html = self._query_search(params)
+        total = _parse_search_meta(html)["total"]
+        fingerprint = _page_fingerprint(_parse_search_html(html))
+        stored = self._accounted_count(kaust)
+        if not full and last_total == total and stored >= total and last_fingerprint == fingerprint:
+            logger.info(f"{kaust}: unchanged ({total} frames), skipping")
+            conn.execute(self._TOUCH_SYNC, (kaust,))
+            conn.commit()
+            SYNC_RESULTS.inc(result="unchanged")
+            return False
+
+        max_id = last_max_id or 0
+        result = "full"
+        if last_total is not None and not full:
+            # Previously complete: new frames are expected on the first pages.
+            summary = self._crawl_search(
+                params, max_pages=max_pages, first_html=html, skip_known=True, stop_at_max_id=max_id
+            )
+            max_id = max(max_id, summary["max_id"])
+            stored = self._accounted_count(kaust)
+            result = "incremental"
+        if result == "full" or stored < total:
+            if result == "incremental":
+                logger.info(f"{kaust}: {stored}/{total} frames after incremental sync, walking all pages")
+                result = "fallback"
+            summary = self._crawl_search(params, max_pages=max_pages, first_html=html, skip_known=not full)
+            max_id = max(max_id, summary["max_id"])
+            stored = self._accounted_count(kaust)
+
+        # last_total is only recorded for a complete folder, so a partial sync
+        # (max_pages reached, transient failures) never qualifies as "unchanged".
+        complete = stored >= total
+        if not complete:
+            logger.warning(f"{kaust}: only {stored}/{total} frames accounted for, sync stays incomplete")
+        conn.execute(self._UPSERT_SYNC, (kaust, total if complete else None, max_id, fingerprint))
+        conn.commit()
+        SYNC_RESULTS.inc(result=result)
+        return True
 
     def ingest_bbox(self, box: BBoxParams) -> None:
         """Fetch GeoJSON metadata inside a bounding-box and download images.
@@ -261,33 +365,152 @@ class FotoladuDownloader:
         storing only the ``variant`` path in the database.
         """
 
+        self.ingest(self.fetch_bbox(box))
+
+    @staticmethod
+    def fetch_bbox(box: BBoxParams) -> List[Dict[str, Any]]:
+        """Return the frames of a bounding-box query as metadata rows (no ingest).
+
+        Rows use the same keys as search results (``id``, ``B``, ``L``, ...).
+        """
         gj = _http_get(BBOX_URL, params=box.to_query(), json=True)
-        entries = [feat["properties"] for feat in gj.get("features", [])]
-        self._bulk_ingest(entries)
+        return [_feature_meta(feat) for feat in gj.get("features", [])]
+
+    def ingest(self, metas: List[Dict[str, Any]]) -> None:
+        """Download and store metadata rows fetched elsewhere (e.g. ``fetch_bbox``).
+
+        Rows without an ``id`` cannot be stored and are skipped.
+        """
+        valid = [m for m in metas if m.get("id") is not None]
+        if len(valid) < len(metas):
+            logger.warning(f"Skipping {len(metas) - len(valid)} rows without a frame id")
+            INGESTED_ROWS.inc(len(metas) - len(valid), outcome="failed")
+        self._bulk_ingest(valid)
 
     def nearest(self, lat: float, lon: float, *, year: str = "", leier: str = "1963") -> Dict[str, Any]:
         """Return the raw JSON of the “nearest frames” endpoint."""
 
         return _http_get(NEAREST_URL, params=dict(B=lat, L=lon, leier=leier, aasta=year), json=True)
 
+    def fetch_variant(self, meta: Dict[str, Any], variant: str) -> Path:
+        """Return the local file of one image variant, downloading it if missing.
+
+        *meta* needs ``peakaust``, ``kaust`` and ``fail``.  Raises
+        ``requests.HTTPError`` when Fotoladu does not have the variant.
+        """
+        return self._fetch_variant(meta, variant)
+
+    def known_ids(self, ids: List[Any]) -> set:
+        """Return the subset of fotoladu ids already stored in ``image``."""
+        ids = [i for i in ids if i is not None]
+        if not ids:
+            return set()
+        sql = f"SELECT fotoladu_id FROM image WHERE fotoladu_id IN ({','.join('?' * len(ids))})"
+        return {r[0] for r in self._get_conn().execute(sql, ids)}
+
     # ------------------------------------------------------------------
     # Internal helpers
     # ------------------------------------------------------------------
 
+    def _crawl_search(
+        self,
+        params: SearchParams,
+        *,
+        max_pages: int,
+        first_html: str | None = None,
+        skip_known: bool = False,
+        stop_at_max_id: int | None = None,
+    ) -> Dict[str, int]:
+        """Walk the result pages of *params* and ingest their frames.
+
+        ``first_html`` reuses an already fetched first page.  With
+        ``skip_known`` rows already in the DB (stored or in
+        ``skipped_frame``) are not re-ingested.  With
+        ``stop_at_max_id`` the walk ends at the first page whose ids are all
+        known and none of them above that id.
+        """
+        html = first_html if first_html is not None else self._query_search(params)
+        entries = _parse_search_html(html)
+        meta = _parse_search_meta(html)
+
+        page_size = meta.get("rows", 0) * meta.get("limit", 0)
+        if not page_size:
+            page_size = len(entries)
+        total_pages = meta.get("pages") or 1
+        if meta.get("total") and page_size:
+            total_pages = max(total_pages, (meta["total"] + page_size - 1) // page_size)
+
+        max_id = 0
+        pages = 0
+        for page in range(max(1, min(total_pages, max_pages))):
+            if page:
+                params.start = page * page_size
+                entries = _parse_search_html(self._query_search(params))
+            pages += 1
+            if not entries:
+                break
+            page_ids = [int(e["id"]) for e in entries if e.get("id") is not None]
+            page_max = max(page_ids, default=0)
+            max_id = max(max_id, page_max)
+            if skip_known or stop_at_max_id is not None:
+                known = self.known_ids(page_ids) | self._skipped_ids(page_ids)
+                new = [e for e in entries if e.get("id") is None or int(e["id"]) not in known]
+                if stop_at_max_id is not None and not new and page_max <= stop_at_max_id:
+                    logger.debug(f"Page {page} has only known ids, stopping")
+                    break
+                if skip_known:
+                    entries = new
+            self._bulk_ingest(entries)
+        logging.info(f"Processed {pages} pages, with approx {page_size * pages} records")
+        return {"total": meta.get("total", 0), "pages": pages, "max_id": max_id}
+
     @staticmethod
     def _query_search(params: SearchParams | int) -> str:
         if isinstance(params, int):
             params = SearchParams(foto_nr=params)
         return _http_get(SEARCH_URL, params=params.to_query())
 
+    def _accounted_count(self, kaust: str) -> int:
+        return self._get_conn().execute(self._COUNT_KAUST, (kaust, kaust)).fetchone()[0]
+
+    def _skipped_ids(self, ids: List[int]) -> set:
+        if not ids:
+            return set()
+        sql = self._SELECT_SKIPPED.format(",".join("?" * len(ids)))
+        return {r[0] for r in self._get_conn().execute(sql, ids)}
+
+    def _record_skip(self, conn: sqlite3.Connection, meta: Dict[str, Any], reason: str) -> None:
+        """Remember a frame that will not be stored, so syncs count it as done."""
+        conn.execute(self._INSERT_SKIP, (meta.get("id"), meta.get("kaust"), reason))
+        conn.commit()
+
     def _bulk_ingest(self, metas: List[Dict[str, Any]]) -> None:
         """Insert a batch of metadata rows and download images."""
         conn = self._get_conn()
         try:
             for meta in metas:
-                path = self._download_image(meta)
-                self._insert_db(conn, meta, path)
-            conn.commit()
+                try:
+                    # Thumb first: it is tiny and its hash decides whether the
+                    # main variant is worth downloading at all.
+                    hashes = hash_file(self._fetch_variant(meta, "thumbs"))
+                    if self.skip_duplicates and hashes and self._is_duplicate(conn, meta, hashes):
+                        INGESTED_ROWS.inc(outcome="duplicate")
+                        self._record_skip(conn, meta, "duplicate")
+                        continue
+                    path = self._download_image(meta)
+                except requests.HTTPError as err:
+                    # Missing file for one frame should not abort the page.
+                    logger.warning(f"Skipping {meta.get('id')}: {err}")
+                    INGESTED_ROWS.inc(outcome="failed")
+                    if err.response is not None and err.response.status_code in (404, 410):
+                        self._record_skip(conn, meta, "missing")
+                    continue
+                with metrics.SQLITE_SECONDS.time(component="downloader", op="insert"):
+                    self._insert_db(conn, meta, path, hashes)
+                # Commit per frame: the write lock is not held across image
+                # downloads, and parallel downloaders see the new hash at once.
+                with metrics.SQLITE_SECONDS.time(component="downloader", op="commit"):
+                    conn.commit()
         except KeyboardInterrupt:  # pragma: no cover - user triggered
             logger.info("Interrupted. Committing partial results before exit.")
             conn.commit()
@@ -299,26 +522,46 @@ class FotoladuDownloader:
 
     def _download_image(self, meta: Dict[str, Any]) -> Path:
         """Download both 'reduced' and thumbnail variants of an image."""
-
-        def _get(variant: str) -> Path:
-            url = f"{IMAGE_URL}/{meta['peakaust']}/{meta['kaust']}/{variant}/{meta['fail']}"
-            dest_dir = self.base_path / meta["peakaust"] / meta["kaust"] / variant
-            dest_dir.mkdir(parents=True, exist_ok=True)
-            dest = dest_dir / meta["fail"]
-            if not dest.exists():
-                logger.debug("Downloading " + str(dest))
-                data = requests.get(url, timeout=60).content
-                dest.write_bytes(data)
-            else:
-                logger.debug("Skipping DL " + str(dest))
-            return dest
-
         # Always download the main variant and a thumbnail
-        path = _get(self.variant)
+        path = self._fetch_variant(meta, self.variant)
         if self.variant != "thumbs":
-            _get("thumbs")
+            self._fetch_variant(meta, "thumbs")
         return path
 
+    def _fetch_variant(self, meta: Dict[str, Any], variant: str) -> Path:
+        """Download one variant of an image unless it is already on disk."""
+        url = f"{IMAGE_URL}/{meta['peakaust']}/{meta['kaust']}/{variant}/{meta['fail']}"
+        dest_dir = self.base_path / meta["peakaust"] / meta["kaust"] / variant
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        dest = dest_dir / meta["fail"]
+        if not dest.exists():
+            logger.debug("Downloading " + str(dest))
+            IMAGE_CACHE.inc(result="miss")
+            resp = UPSTREAM.get(url, endpoint="image", timeout=60)
+            resp.raise_for_status()
+            data = resp.content
+            dest.write_bytes(data)
+            DOWNLOADED_BYTES.inc(len(data), variant=variant)
+            DOWNLOADED_IMAGES.inc(variant=variant)
+        else:
+            logger.debug("Skipping DL " + str(dest))
+            IMAGE_CACHE.inc(result="hit")
+        return dest
+
+    # Duplicate check ---------------------------------------------------
+
+    def _is_duplicate(self, conn: sqlite3.Connection, meta: Dict[str, Any], hashes: tuple[int, int]) -> bool:
+        """Return True if another fotoladu_id already holds the same frame."""
+        if self._duplicates is None:
+            self._duplicates = DuplicateIndex(db_path=self.db_path)
+        # Every call: other downloaders/threads/scripts may have added hashes.
+        self._duplicates.refresh(conn)
+        own_id = int(meta["id"])
+        matches = [m for m in self._duplicates.find(hashes) if int(m[1]) != own_id]
+        if matches:
+            logger.info(f"Skipping {meta.get('id')}: duplicate of fotoladu_id {matches[0][1]}")
+        return bool(matches)
+
     # SQLite insert -----------------------------------------------------
 
     _INSERT_IMG = (
@@ -327,9 +570,32 @@ class FotoladuDownloader:
     )
     _INSERT_LOC = "INSERT OR IGNORE INTO location (image_id, lat, lon, confidence) VALUES (?,?,?,?)"
     _SELECT_IMG_ID = "SELECT id FROM image WHERE fotoladu_id = ?"
+    _SELECT_SYNC = "SELECT last_total, max_fotoladu_id, page_fingerprint FROM kaust_sync WHERE kaust = ?"
+    _UPSERT_SYNC = (
+        "INSERT OR REPLACE INTO kaust_sync (kaust, last_total, max_fotoladu_id, page_fingerprint, synced_at) "
+        "VALUES (?,?,?,?,datetime('now'))"
+    )
+    _COUNT_KAUST = (
+        "SELECT (SELECT count(*) FROM image WHERE kaust = ?) "
+        "+ (SELECT count(*) FROM skipped_frame WHERE kaust = ?)"
+    )
+    _INSERT_SKIP = (
+        "INSERT OR REPLACE INTO skipped_frame (fotoladu_id, kaust, reason, skipped_at) "
+        "VALUES (?,?,?,datetime('now'))"
+    )
+    _SELECT_SKIPPED = "SELECT fotoladu_id FROM skipped_frame WHERE fotoladu_id IN ({})"
+    _DELETE_SKIP = "DELETE FROM skipped_frame WHERE fotoladu_id = ?"
+    _TOUCH_SYNC = "UPDATE kaust_sync SET synced_at = datetime('now') WHERE kaust = ?"
+    _INSERT_HASH = "INSERT OR IGNORE INTO image_hash (image_id, dhash, phash) VALUES (?,?,?)"
 
-    def _insert_db(self, db: sqlite3.Connection, meta: Dict[str, Any], path: Path) -> None:
-        db.execute(
+    def _insert_db(
+        self,
+        db: sqlite3.Connection,
+        meta: Dict[str, Any],
+        path: Path,
+        hashes: tuple[int, int] | None = None,
+    ) -> None:
+        cur = db.execute(
             self._INSERT_IMG,
             (
                 meta.get("id"),
@@ -347,6 +613,17 @@ class FotoladuDownloader:
                 meta.get("allikas"),
             ),
         )
+        INGESTED_ROWS.inc(outcome="inserted" if cur.rowcount else "known")
+        if cur.rowcount:
+            # Stored after all (e.g. a full re-sync): no longer a skip.
+            db.execute(self._DELETE_SKIP, (meta.get("id"),))
         row = db.execute(self._SELECT_IMG_ID, (meta.get("id"),)).fetchone()
         if row:
             db.execute(self._INSERT_LOC, (row[0], meta.get("B"), meta.get("L"), meta.get("tapsus")))
+            flight_row = flight_frame_row(row[0], meta)
+            if flight_row:
+                db.execute(INSERT_FLIGHT_FRAME, flight_row)
+            if hashes:
+                cur = db.execute(self._INSERT_HASH, (row[0], to_signed(hashes[0]), to_signed(hashes[1])))
+                if cur.rowcount and self._duplicates is not None:
+                    self._duplicates.add(row[0], meta.get("id"), hashes)
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+"""src/exporter.py - streaming bulk export of image metadata.
+
+Rows of ``image`` are joined with their latest ``location`` row and all
+``tag`` rows (as a JSON object ``{"tag": state}``) and streamed as NDJSON,
+CSV or Parquet.
+
+* **Flat memory** - rows are read in fixed-size chunks using keyset
+  pagination (``id > last_id ORDER BY id LIMIT n``) and each chunk is encoded
+  and handed out before the next one is read.
+* **Non-blocking** - a read-only connection is used and every chunk is its
+  own short read transaction, so in WAL mode writers (the downloader) and
+  checkpoints are never held up by a long export.
+* **Resumable** - every row carries ``id``; pass the last seen value back as
+  ``after_id`` to continue an interrupted export.
+
+Parquet needs ``pyarrow``; it is imported lazily so the other formats work
+without it.
+"""
+
+import csv
+import io
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from src.flight_index import MIN_ANCHOR_CONFIDENCE
+
+__all__ = [
+    "FORMATS",
+    "MetadataExporter",
+]
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+COLUMNS = [
+    "id", "fotoladu_id", "path", "aasta", "w", "h", "peakaust", "kaust", "fail",
+    "lend", "fotonr", "kaardileht", "tyyp", "allikas",
+    "lat", "lon", "loc_confidence", "loc_source", "tags",
+]
+
+_SELECT = (
+    "SELECT i.id, i.fotoladu_id, i.path, i.aasta, i.w, i.h, i.peakaust, i.kaust, i.fail, "
+    "i.lend, i.fotonr, i.kaardileht, i.tyyp, i.allikas, "
+    "l.lat, l.lon, CAST(l.confidence AS REAL), l.source, "
+    "(SELECT json_group_object(t.tag, t.state) FROM tag t WHERE t.image_id = i.id) "
+    "FROM image i "
+    "LEFT JOIN location l ON l.id = (SELECT max(id) FROM location WHERE image_id = i.id) "
+    "WHERE i.id > ?{filters} "
+    "ORDER BY i.id LIMIT ?"
+)
+
+# Column filters accepted by ``MetadataExporter.iter_chunks``
+_EQ_FILTERS = ("aasta", "peakaust", "kaust", "lend", "kaardileht", "tyyp")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that keeps its position across ``drain`` calls.
+
+    The Parquet writer records absolute offsets in the footer, so ``tell``
+    must count every byte ever written even though the buffer is emptied after
+    each row group.
+    """
+
+    def __init__(self) -> None:
+        self._parts: List[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        data = bytes(b)
+        self._parts.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+class MetadataExporter:
+    """Chunked, read-only export of ``image`` + ``location`` + ``tag``."""
+
+    def __init__(self, *, db_path: Path | str, chunk_size: int = 1000) -> None:
+        self.db_path = Path(db_path)
+        self.chunk_size = chunk_size
+
+    # ---- Public API ----------------------------------------------------
+
+    def iter_chunks(
+        self,
+        *,
+        after_id: int = 0,
+        limit: Optional[int] = None,
+        tag: Optional[str] = None,
+        georeferenced: Optional[bool] = None,
+        **filters: Optional[str],
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """Yield lists of at most ``chunk_size`` rows ordered by ``id``.
+
+        ``filters`` are equality filters on ``aasta``, ``peakaust``, ``kaust``,
+        ``lend``, ``kaardileht`` and ``tyyp``; ``tag`` keeps images carrying
+        that tag and ``georeferenced`` those with (or without) an exact position
+        (same ``tapsus`` rule as the flight index).
+        """
+        where, args = self._where(tag=tag, georeferenced=georeferenced, **filters)
+        sql = _SELECT.format(filters=where)
+        remaining = limit
+        conn = sqlite3.connect(f"file:{self.db_path.as_posix()}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            while remaining is None or remaining > 0:
+                n = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+                rows = conn.execute(sql, (after_id, *args, n)).fetchall()
+                if not rows:
+                    return
+                chunk = [dict(zip(COLUMNS, r)) for r in rows]
+                for row in chunk:
+                    row["tags"] = json.loads(row["tags"]) if row["tags"] else {}
+                yield chunk
+                after_id = rows[-1][0]
+                if remaining is not None:
+                    remaining -= len(rows)
+                if len(rows) < n:
+                    return
+        finally:
+            conn.close()
+
+    def stream(self, fmt: str, **kwargs: Any) -> Iterator[bytes]:
+        """Encode ``iter_chunks(**kwargs)`` as *fmt*, one piece per chunk."""
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown format {fmt!r}, expected one of {tuple(FORMATS)}")
+        chunks = self.iter_chunks(**kwargs)
+        return getattr(self, f"_stream_{fmt}")(chunks)
+
+    # ---- Encoders ------------------------------------------------------
+
+    @staticmethod
+    def _stream_ndjson(chunks: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+        for chunk in chunks:
+            yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk).encode()
+
+    @staticmethod
+    def _stream_csv(chunks: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=COLUMNS)
+        writer.writeheader()
+        for chunk in chunks:
+            for row in chunk:
+                writer.writerow({**row, "tags": json.dumps(row["tags"], ensure_ascii=False)})
+            yield buf.getvalue().encode()
+            buf.seek(0)
+            buf.truncate()
+        if buf.tell():  # header only, empty export
+            yield buf.getvalue().encode()
+
+    @staticmethod
+    def _stream_parquet(chunks: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema(
+            [(c, pa.int64()) for c in ("id", "fotoladu_id")]
+            + [(c, pa.string()) for c in ("path", "aasta")]
+            + [(c, pa.int64()) for c in ("w", "h")]
+            + [(c, pa.string()) for c in ("peakaust", "kaust", "fail", "lend", "fotonr", "kaardileht", "tyyp", "allikas")]
+            + [(c, pa.float64()) for c in ("lat", "lon", "loc_confidence")]
+            + [(c, pa.string()) for c in ("loc_source", "tags")]
+        )
+        sink = _ChunkSink()
+        writer = pq.ParquetWriter(sink, schema)
+        try:
+            for chunk in chunks:
+                rows = [{**_as_schema_types(row), "tags": json.dumps(row["tags"], ensure_ascii=False)} for row in chunk]
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                yield sink.drain()
+        finally:
+            writer.close()
+        yield sink.drain()
+
+    # ---- Internal helpers ----------------------------------------------
+
+    @staticmethod
+    def _where(
+        *, tag: Optional[str], georeferenced: Optional[bool], **filters: Optional[str]
+    ) -> Tuple[str, List[Any]]:
+        clauses: List[str] = []
+        args: List[Any] = []
+        for name, value in filters.items():
+            if name not in _EQ_FILTERS:
+                raise ValueError(f"unknown filter {name!r}")
+            if value is not None:
+                clauses.append(f"i.{name} = ?")
+                args.append(value)
+        if tag is not None:
+            clauses.append("EXISTS (SELECT 1 FROM tag t WHERE t.image_id = i.id AND t.tag = ?)")
+            args.append(tag)
+        if georeferenced is not None:
+            # COALESCE keeps the expression two-valued, so a NULL confidence
+            # lands in the "not georeferenced" export instead of neither.
+            anchored = (
+                f"(l.lat IS NOT NULL AND COALESCE(CAST(l.confidence AS INTEGER), -1) >= {MIN_ANCHOR_CONFIDENCE})"
+            )
+            clauses.append(anchored if georeferenced else f"NOT {anchored}")
+        return "".join(f" AND {c}" for c in clauses), args
+
+
+def _as_schema_types(row: Dict[str, Any]) -> Dict[str, Any]:
+    """SQLite columns are loosely typed; coerce to the Parquet schema."""
+    out = dict(row)
+    for c in ("path", "aasta", "peakaust", "kaust", "fail", "lend", "fotonr", "kaardileht", "tyyp", "allikas", "loc_source"):
+        if out[c] is not None:
+            out[c] = str(out[c])
+    for c in ("w", "h"):
+        try:
+            out[c] = None if out[c] is None else int(out[c])
+        except (TypeError, ValueError):
+            out[c] = None
+    return out
@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+"""src/feature_matching.py - overlap matching of consecutive flight frames.
+
+Frames of one flight are shot sequentially with a large forward overlap, so
+the relative position of frame *n+1* can be estimated from frame *n* by
+matching keypoints in the shared area (see readme, "Possible path of
+solutions").
+
+The pipeline has two passes, both running in a process pool:
+
+1. **Extract** - ORB/AKAZE keypoints are computed once per frame from the
+   stored variant and cached under ``data/features`` as small ``.npz`` files
+   (``pts`` float32 ``N x 2`` + ``desc`` uint8 ``N x 32/61``).
+2. **Match** - only frames that are neighbours in ``fotonr`` order are
+   matched, so the cost stays linear in the flight length.  The homography
+   and the offset of the frame centre are written to ``frame_match``.
+
+Usage
+-----
+```python
+from src.feature_matching import FlightMatcher
+
+with FlightMatcher(db_path=Path("db/fotoladu.sqlite.db")) as fm:
+    fm.match_flight("158-C-871-73")
+```
+
+The worker pool is started on first use and kept until ``close()`` (or the
+end of the ``with`` block), so matching many flights pays the process
+start-up only once.
+"""
+
+import json
+import logging
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+__all__ = [
+    "DescriptorStore",
+    "FlightMatcher",
+    "extract_features",
+    "match_features",
+]
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# Constants
+# ---------------------------------------------------------------------------
+
+FEATURES_DIR = Path("data/features")
+DETECTORS = ("orb", "akaze")
+N_FEATURES = 2000
+RATIO = 0.75  # Lowe's ratio test
+MIN_INLIERS = 12
+
+# ---------------------------------------------------------------------------
+# Feature extraction / matching (module-level so they pickle for the pool)
+# ---------------------------------------------------------------------------
+
+
+def _detector(name: str):
+    if name == "orb":
+        return cv2.ORB_create(nfeatures=N_FEATURES)
+    if name == "akaze":
+        return cv2.AKAZE_create()
+    raise ValueError(f"unknown detector {name!r}, expected one of {DETECTORS}")
+
+
+def extract_features(path: Path | str, detector: str = "orb") -> Tuple[np.ndarray, np.ndarray]:
+    """Return ``(pts, desc)`` for the image at *path*.
+
+    ``pts`` holds keypoint coordinates only; scale and angle are not needed for
+    homography estimation and would triple the cache size.
+    """
+    img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise FileNotFoundError(path)
+    return _detect(img, detector)
+
+
+def _detect(img: np.ndarray, detector: str) -> Tuple[np.ndarray, np.ndarray]:
+    kps, desc = _detector(detector).detectAndCompute(img, None)
+    pts = np.array([kp.pt for kp in kps], dtype=np.float32).reshape(-1, 2)
+    if desc is None:
+        desc = np.empty((0, 32), dtype=np.uint8)
+    return pts, desc
+
+
+def match_features(
+    a: Tuple[np.ndarray, np.ndarray],
+    b: Tuple[np.ndarray, np.ndarray],
+    size_a: Tuple[int, int],
+) -> Optional[Dict[str, Any]]:
+    """Estimate the homography mapping frame *a* onto frame *b*.
+
+    ``size_a`` is ``(w, h)`` of frame *a*; the returned ``dx``/``dy`` is where
+    its centre lands in *b*, relative to the centre of *a*.  Returns ``None``
+    when too few consistent matches are found (e.g. a gap in the flight).
+    """
+    pts_a, desc_a = a
+    pts_b, desc_b = b
+    if len(desc_a) < 2 or len(desc_b) < 2:
+        return None
+
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    good = [
+        m[0]
+        for m in matcher.knnMatch(desc_a, desc_b, k=2)
+        if len(m) == 2 and m[0].distance < RATIO * m[1].distance
+    ]
+    if len(good) < MIN_INLIERS:
+        return None
+
+    src = pts_a[[m.queryIdx for m in good]].reshape(-1, 1, 2)
+    dst = pts_b[[m.trainIdx for m in good]].reshape(-1, 1, 2)
+    H, mask = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+    if H is None:
+        return None
+    inliers = int(mask.sum())
+    if inliers < MIN_INLIERS:
+        return None
+
+    w, h = size_a
+    centre = np.array([[[w / 2.0, h / 2.0]]], dtype=np.float64)
+    moved = cv2.perspectiveTransform(centre, H)[0, 0]
+    return {
+        "matches": len(good),
+        "inliers": inliers,
+        "dx": float(moved[0] - w / 2.0),
+        "dy": float(moved[1] - h / 2.0),
+        "homography": H.flatten().tolist(),
+    }
+
+
+def _extract_job(src: str, dest: str, detector: str) -> Tuple[str, Tuple[int, int]]:
+    img = cv2.imread(src, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise FileNotFoundError(src)
+    pts, desc = _detect(img, detector)
+    h, w = img.shape[:2]
+    Path(dest).parent.mkdir(parents=True, exist_ok=True)
+    np.savez(dest, pts=pts, desc=desc, size=np.array([w, h], dtype=np.int32))
+    return dest, (w, h)
+
+
+def _match_job(id_a: int, id_b: int, npz_a: str, npz_b: str) -> Tuple[int, int, Optional[Dict[str, Any]]]:
+    with np.load(npz_a) as a, np.load(npz_b) as b:
+        size_a = tuple(int(v) for v in a["size"])
+        result = match_features((a["pts"], a["desc"]), (b["pts"], b["desc"]), size_a)
+    return id_a, id_b, result
+
+
+# ---------------------------------------------------------------------------
+# Descriptor cache
+# ---------------------------------------------------------------------------
+
+
+class DescriptorStore:
+    """On-disk cache of keypoints/descriptors mirroring the ``data/raw`` tree.
+
+    ``data/raw/<peakaust>/<kaust>/<variant>/<fail>`` is cached as
+    ``data/features/<detector>/<peakaust>/<kaust>/<variant>/<fail>.npz``.
+    """
+
+    def __init__(self, base_path: Path | str = FEATURES_DIR, *, detector: str = "orb") -> None:
+        if detector not in DETECTORS:
+            raise ValueError(f"unknown detector {detector!r}, expected one of {DETECTORS}")
+        self.base_path = Path(base_path)
+        self.detector = detector
+
+    def path_for(self, image_path: Path | str) -> Path:
+        parts = Path(image_path).parts[-4:]
+        return self.base_path / self.detector / Path(*parts).with_suffix(".npz")
+
+    def has(self, image_path: Path | str) -> bool:
+        return self.path_for(image_path).exists()
+
+    def load(self, image_path: Path | str) -> Tuple[np.ndarray, np.ndarray]:
+        with np.load(self.path_for(image_path)) as data:
+            return data["pts"], data["desc"]
+
+    def get(self, image_path: Path | str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return cached features, extracting them first if needed."""
+        if not self.has(image_path):
+            _extract_job(str(image_path), str(self.path_for(image_path)), self.detector)
+        return self.load(image_path)
+
+
+# ---------------------------------------------------------------------------
+# Flight matcher
+# ---------------------------------------------------------------------------
+
+
+class FlightMatcher:
+    """Match neighbouring frames of a flight and persist the results."""
+
+    _SELECT_FRAMES = (
+        "SELECT id, path, lend, fotonr FROM image WHERE kaust = ? "
+        "ORDER BY lend, CAST(fotonr AS INTEGER)"
+    )
+    _SELECT_FLIGHTS = "SELECT DISTINCT kaust FROM image WHERE kaust IS NOT NULL ORDER BY kaust"
+    _UPSERT_MATCH = (
+        "INSERT OR REPLACE INTO frame_match "
+        "(image_a, image_b, detector, matches, inliers, dx, dy, homography) "
+        "VALUES (?,?,?,?,?,?,?,?)"
+    )
+
+    def __init__(
+        self,
+        *,
+        db_path: Path | str,
+        store: DescriptorStore | None = None,
+        workers: int | None = None,
+        max_gap: int = 2,
+    ) -> None:
+        """``max_gap`` is the largest ``fotonr`` step still treated as overlap."""
+        self.db_path = Path(db_path)
+        self.store = store or DescriptorStore()
+        self.workers = workers
+        self.max_gap = max_gap
+        self._executor: ProcessPoolExecutor | None = None
+
+    def __enter__(self) -> "FlightMatcher":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Shut down the worker pool if it was started."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    # ---- Public API ----------------------------------------------------
+
+    def kausts(self) -> List[str]:
+        with sqlite3.connect(self.db_path) as conn:
+            return [r[0] for r in conn.execute(self._SELECT_FLIGHTS)]
+
+    def match_flight(self, kaust: str) -> int:
+        """Match all neighbouring frames in *kaust*; return stored pair count."""
+        with sqlite3.connect(self.db_path) as conn:
+            frames = conn.execute(self._SELECT_FRAMES, (kaust,)).fetchall()
+        pairs = self._neighbour_pairs(frames)
+        if not pairs:
+            return 0
+
+        paths = {fid: path for fid, path, _, _ in frames}
+        needed = {fid for pair in pairs for fid in pair}
+        pool = self._pool()
+        try:
+            self._extract_missing(pool, {fid: paths[fid] for fid in needed})
+            jobs = [
+                pool.submit(
+                    _match_job,
+                    a,
+                    b,
+                    str(self.store.path_for(paths[a])),
+                    str(self.store.path_for(paths[b])),
+                )
+                for a, b in pairs
+                if self.store.has(paths[a]) and self.store.has(paths[b])
+            ]
+            results = [job.result() for job in jobs]
+        except BrokenProcessPool:
+            # A crashed worker breaks the pool for good; start a fresh one
+            # for the next flight.
+            self.close()
+            raise
+
+        stored = 0
+        with sqlite3.connect(self.db_path) as conn:
+            for id_a, id_b, res in results:
+                if res is None:
+                    continue
+                conn.execute(
+                    self._UPSERT_MATCH,
+                    (
+                        id_a,
+                        id_b,
+                        self.store.detector,
+                        res["matches"],
+                        res["inliers"],
+                        res["dx"],
+                        res["dy"],
+                        json.dumps(res["homography"]),
+                    ),
+                )
+                stored += 1
+            conn.commit()
+        logger.info(f"{kaust}: matched {stored}/{len(pairs)} neighbouring pairs")
+        return stored
+
+    # ---- Internal helpers ----------------------------------------------
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _neighbour_pairs(self, frames: List[Tuple[int, str, str, str]]) -> List[Tuple[int, int]]:
+        pairs = []
+        for (id_a, _, lend_a, nr_a), (id_b, _, lend_b, nr_b) in zip(frames, frames[1:]):
+            if lend_a != lend_b:
+                continue
+            try:
+                gap = int(nr_b) - int(nr_a)
+            except (TypeError, ValueError):
+                continue
+            if 0 < gap <= self.max_gap:
+                pairs.append((id_a, id_b))
+        return pairs
+
+    def _extract_missing(self, pool: ProcessPoolExecutor, paths: Dict[int, str]) -> None:
+        jobs = [
+            pool.submit(_extract_job, path, str(self.store.path_for(path)), self.store.detector)
+            for path in paths.values()
+            if not self.store.has(path) and Path(path).exists()
+        ]
+        for job in jobs:
+            try:
+                job.result()
+            except Exception as err:
+                logger.warning(f"Feature extraction failed: {err}")
@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+"""src/flight_index.py - flight-sequence index and next-frame prediction.
+
+``image.lend`` / ``image.fotonr`` are free-form TEXT, so "which frames come
+before and after this one" used to be a table scan.  This module keeps a
+normalised ``flight_frame`` table (numeric flight + frame numbers, indexed)
+and an in-memory copy of every flight as sorted numpy arrays.
+
+Frames are usually shot 3-5 km apart at a steady interval, so the position of
+an untagged frame can be interpolated (or extrapolated) linearly on the frame
+number from the nearest georeferenced frames of the same flight.
+
+```python
+idx = FlightIndex(db_path=DB_PATH)
+idx.predict(42)
+# {"image_id": 42, "lat": 58.71, "lon": 27.15, "method": "interpolate",
+#  "anchors": [40, 45], "gap": 2}
+```
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src import metrics
+
+__all__ = [
+    "FlightIndex",
+    "flight_frame_row",
+    "flight_key",
+    "parse_number",
+]
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = metrics.counter(
+    "flight_index_lookups_total", "Index lookups, miss = arrays had to be reloaded", ("result",)
+)
+
+# tapsus flag stored in location.confidence: 0 = rough, 1 = unknown,
+# 2 = exact, 3 = user-set.  Only the last two are usable as anchors.
+MIN_ANCHOR_CONFIDENCE = 2
+
+_DIGITS = re.compile(r"\d+")
+_NON_ALNUM = re.compile(r"[^0-9A-Za-z]")
+
+# ---------------------------------------------------------------------------
+# Parsing helpers
+# ---------------------------------------------------------------------------
+
+
+def parse_number(value: Any) -> Optional[int]:
+    """Return the first integer inside *value* (``"C-602"`` -> ``602``)."""
+    if value is None:
+        return None
+    m = _DIGITS.search(str(value))
+    return int(m.group(0)) if m else None
+
+
+def flight_key(aasta: Any, lend: Any) -> Optional[str]:
+    """Normalised flight identifier, e.g. ``("1970", "C-602")`` -> ``"1970:C602"``.
+
+    Flight numbers are reused across years, hence the year prefix.
+    """
+    if lend is None or str(lend).strip() == "":
+        return None
+    return f"{aasta or ''}:{_NON_ALNUM.sub('', str(lend)).upper()}"
+
+
+def flight_frame_row(image_id: int, meta: Dict[str, Any]) -> Optional[Tuple[int, str, Optional[int], Optional[int]]]:
+    """Return the ``flight_frame`` row for an image, or ``None`` without a flight."""
+    key = flight_key(meta.get("aasta"), meta.get("lend"))
+    if key is None:
+        return None
+    return image_id, key, parse_number(meta.get("lend")), parse_number(meta.get("fotonr"))
+
+
+INSERT_FLIGHT_FRAME = (
+    "INSERT OR IGNORE INTO flight_frame (image_id, flight, flight_no, frame_no) VALUES (?,?,?,?)"
+)
+
+# ---------------------------------------------------------------------------
+# In-memory index
+# ---------------------------------------------------------------------------
+
+
+@dataclass
+class _Flight:
+    frame_no: np.ndarray  # int64, sorted
+    image_id: np.ndarray  # int64
+    lat: np.ndarray  # float64, NaN where not georeferenced
+    lon: np.ndarray
+
+
+class FlightIndex:
+    """Sorted per-flight arrays loaded from ``flight_frame`` + ``location``.
+
+    The index reloads itself lazily when the tables changed, checking at most
+    once every ``refresh_interval`` seconds, so ``predict`` normally never
+    touches SQLite.  Rows appended since the last check (higher
+    ``flight_frame.image_id`` / ``location.id``) only reload the flights they
+    belong to; anything else reloads everything.  Reads never write: ``flight_frame`` rows are added at
+    ingest, and ``sync`` backfills older images once at startup.
+    """
+
+    _SELECT_UNINDEXED = (
+        "SELECT id, aasta, lend, fotonr FROM image "
+        "WHERE id NOT IN (SELECT image_id FROM flight_frame)"
+    )
+    _SELECT_FRAMES = (
+        "SELECT f.flight, f.frame_no, f.image_id, l.lat, l.lon "
+        "FROM flight_frame f "
+        "LEFT JOIN location l ON l.id = ("
+        "  SELECT id FROM location WHERE image_id = f.image_id AND lat IS NOT NULL "
+        "  AND CAST(confidence AS INTEGER) >= ? ORDER BY id DESC LIMIT 1) "
+        "WHERE f.frame_no IS NOT NULL{flights} "
+        "ORDER BY f.flight, f.frame_no"
+    )
+    _SIGNATURE = (
+        "SELECT (SELECT count(*) FROM flight_frame), "
+        "(SELECT coalesce(max(image_id), 0) FROM flight_frame), "
+        "(SELECT coalesce(max(id), 0) FROM location)"
+    )
+    _NEW_FRAMES = "SELECT flight, count(*) FROM flight_frame WHERE image_id > ? GROUP BY flight"
+    _NEW_LOCATIONS = (
+        "SELECT DISTINCT f.flight FROM location l "
+        "JOIN flight_frame f ON f.image_id = l.image_id WHERE l.id > ?"
+    )
+
+    def __init__(self, *, db_path: Path | str, refresh_interval: float = 5.0) -> None:
+        self.db_path = Path(db_path)
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # (flights, image_id -> (flight, position)), swapped as one object so
+        # readers never see a half-built index.
+        self._data: Tuple[Dict[str, _Flight], Dict[int, Tuple[str, int]]] = ({}, {})
+        self._signature: Tuple[Any, ...] | None = None
+        self._checked_at = 0.0
+
+    # ---- Public API ----------------------------------------------------
+
+    def sync(self, conn: sqlite3.Connection | None = None) -> int:
+        """Add ``flight_frame`` rows for images inserted without one."""
+        own = conn is None
+        conn = conn or sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute(self._SELECT_UNINDEXED).fetchall()
+            values = [
+                r
+                for r in (
+                    flight_frame_row(image_id, {"aasta": aasta, "lend": lend, "fotonr": fotonr})
+                    for image_id, aasta, lend, fotonr in rows
+                )
+                if r is not None
+            ]
+            conn.executemany(INSERT_FLIGHT_FRAME, values)
+            conn.commit()
+        finally:
+            if own:
+                conn.close()
+        if values:
+            logger.info(f"Flight index: backfilled {len(values)} flight_frame rows")
+        return len(values)
+
+    def refresh(self, *, force: bool = False) -> None:
+        """Reload the arrays if the underlying tables changed."""
+        if not force and time.monotonic() - self._checked_at < self.refresh_interval:
+            LOOKUPS.inc(result="hit")
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._checked_at < self.refresh_interval:
+                LOOKUPS.inc(result="hit")
+                return
+            conn = sqlite3.connect(f"file:{self.db_path.as_posix()}?mode=ro", uri=True)
+            try:
+                signature = conn.execute(self._SIGNATURE).fetchone()
+                stale = force or signature != self._signature
+                if stale:
+                    changed = None if force else self._changed_flights(conn, signature)
+                    with metrics.SQLITE_SECONDS.time(
+                        component="flight_index", op="load" if changed is None else "update"
+                    ):
+                        self._load(conn, changed)
+                    self._signature = signature
+            finally:
+                conn.close()
+            LOOKUPS.inc(result="miss" if stale else "hit")
+            self._checked_at = time.monotonic()
+
+    def __contains__(self, image_id: int) -> bool:
+        """True if *image_id* is indexed (known image with flight and frame number)."""
+        self.refresh()
+        return image_id in self._data[1]
+
+    def sequence(self, image_id: int) -> List[Dict[str, Any]]:
+        """Return every frame of *image_id*'s flight in frame order."""
+        self.refresh()
+        flights, by_image = self._data
+        found = by_image.get(image_id)
+        if found is None:
+            return []
+        fl = flights[found[0]]
+        return [
+            {
+                "image_id": int(fl.image_id[i]),
+                "frame_no": int(fl.frame_no[i]),
+                "lat": None if np.isnan(fl.lat[i]) else float(fl.lat[i]),
+                "lon": None if np.isnan(fl.lon[i]) else float(fl.lon[i]),
+            }
+            for i in range(len(fl.frame_no))
+        ]
+
+    def predict(self, image_id: int) -> Optional[Dict[str, Any]]:
+        """Estimate the position of *image_id* from georeferenced neighbours.
+
+        ``method`` is one of ``known`` (frame already georeferenced),
+        ``interpolate`` (anchors on both sides), ``extrapolate`` (two anchors
+        on one side) or ``nearest`` (single anchor in the flight).  ``gap`` is
+        the distance in frames to the closest anchor.  Returns ``None`` when
+        the frame is unknown or its flight has no anchors.
+        """
+        self.refresh()
+        flights, by_image = self._data
+        found = by_image.get(image_id)
+        if found is None:
+            return None
+        key, pos = found
+        fl = flights[key]
+        frame = int(fl.frame_no[pos])
+        out = {"image_id": image_id, "flight": key, "frame_no": frame}
+
+        if not np.isnan(fl.lat[pos]):
+            return {**out, "lat": float(fl.lat[pos]), "lon": float(fl.lon[pos]),
+                    "method": "known", "anchors": [image_id], "gap": 0}
+
+        anchors = np.flatnonzero(~np.isnan(fl.lat) & (fl.frame_no != frame))
+        if len(anchors) == 0:
+            return None
+        split = np.searchsorted(fl.frame_no[anchors], frame)
+        before, after = anchors[:split], anchors[split:]
+
+        if len(before) and len(after):
+            pair, method = (before[-1], after[0]), "interpolate"
+        elif len(before) >= 2:
+            pair, method = (before[-2], before[-1]), "extrapolate"
+        elif len(after) >= 2:
+            pair, method = (after[0], after[1]), "extrapolate"
+        else:
+            pair, method = None, "nearest"
+
+        if pair is None or fl.frame_no[pair[0]] == fl.frame_no[pair[1]]:
+            i = before[-1] if len(before) else after[0]
+            return {**out, "lat": float(fl.lat[i]), "lon": float(fl.lon[i]), "method": "nearest",
+                    "anchors": [int(fl.image_id[i])], "gap": abs(int(fl.frame_no[i]) - frame)}
+
+        i, j = pair
+        fi, fj = int(fl.frame_no[i]), int(fl.frame_no[j])
+        t = (frame - fi) / (fj - fi)
+        return {
+            **out,
+            "lat": float(fl.lat[i] + t * (fl.lat[j] - fl.lat[i])),
+            "lon": float(fl.lon[i] + t * (fl.lon[j] - fl.lon[i])),
+            "method": method,
+            "anchors": [int(fl.image_id[i]), int(fl.image_id[j])],
+            "gap": min(abs(fi - frame), abs(fj - frame)),
+        }
+
+    # ---- Internal helpers ----------------------------------------------
+
+    def _changed_flights(self, conn: sqlite3.Connection, signature: Tuple[Any, ...]) -> Optional[List[str]]:
+        """Flight keys touched by rows appended since the last load.
+
+        ``None`` means the change is not a pure append (first load, deleted
+        rows, a backfill of older image ids) and everything must be reloaded.
+        """
+        if self._signature is None:
+            return None
+        count, max_frame, max_loc = self._signature
+        if signature[0] < count or signature[1] < max_frame or signature[2] < max_loc:
+            return None
+        new_frames = conn.execute(self._NEW_FRAMES, (max_frame,)).fetchall()
+        if count + sum(n for _, n in new_frames) != signature[0]:
+            return None
+        keys = {key for key, _ in new_frames}
+        keys.update(r[0] for r in conn.execute(self._NEW_LOCATIONS, (max_loc,)))
+        return sorted(keys)
+
+    def _load(self, conn: sqlite3.Connection, keys: Optional[List[str]] = None) -> None:
+        """(Re)load all flights, or only *keys* on top of the current index."""
+        if keys is None:
+            flights: Dict[str, _Flight] = {}
+            by_image: Dict[int, Tuple[str, int]] = {}
+            rows = conn.execute(self._SELECT_FRAMES.format(flights=""), (MIN_ANCHOR_CONFIDENCE,)).fetchall()
+        else:
+            old_flights, old_by_image = self._data
+            flights = {k: v for k, v in old_flights.items() if k not in keys}
+            by_image = {i: ref for i, ref in old_by_image.items() if ref[0] not in keys}
+            rows = []
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                sql = self._SELECT_FRAMES.format(flights=f" AND f.flight IN ({','.join('?' * len(chunk))})")
+                rows.extend(conn.execute(sql, (MIN_ANCHOR_CONFIDENCE, *chunk)))
+            rows.sort(key=lambda r: (r[0], r[1]))
+
+        start = 0
+        for end in range(1, len(rows) + 1):
+            if end < len(rows) and rows[end][0] == rows[start][0]:
+                continue
+            chunk = rows[start:end]
+            key = chunk[0][0]
+            flights[key] = _Flight(
+                frame_no=np.array([r[1] for r in chunk], dtype=np.int64),
+                image_id=np.array([r[2] for r in chunk], dtype=np.int64),
+                lat=np.array([np.nan if r[3] is None else r[3] for r in chunk], dtype=np.float64),
+                lon=np.array([np.nan if r[4] is None else r[4] for r in chunk], dtype=np.float64),
+            )
+            for pos, r in enumerate(chunk):
+                by_image[r[2]] = (key, pos)
+            start = end
+        self._data = (flights, by_image)
+        logger.debug(
+            f"Flight index {'loaded' if keys is None else f'updated {len(keys)} flights'}: "
+            f"{len(flights)} flights, {len(by_image)} frames"
+        )
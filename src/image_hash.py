@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+"""src/image_hash.py - perceptual hashes and near-duplicate lookup.
+
+The same negative is published in several ``peakaust`` trees (``ma_neg`` vs
+``ma_neg_ngr``, see development notes), under different ids and file names.
+Two 64-bit perceptual hashes are computed from the 100 px ``thumbs`` variant:
+
+* **dHash** - sign of horizontal gradients on a 9x8 grey thumbnail; cheap and
+  used as the search key.
+* **pHash** - sign of the low-frequency 8x8 DCT block against its median;
+  robust to tone changes and used to confirm a dHash candidate.
+
+A frame counts as a *confirmed* duplicate when both distances are within
+their thresholds.  Lookups go through a multi-index hash on dHash, so a query
+only verifies frames sharing an exact 8-bit block of the query's dHash.
+"""
+
+import logging
+import sqlite3
+import threading
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import cv2
+import numpy as np
+
+__all__ = [
+    "DuplicateIndex",
+    "MultiIndexHash",
+    "dhash",
+    "hamming",
+    "hash_file",
+    "phash",
+]
+
+logger = logging.getLogger(__name__)
+
+DHASH_MAX_DISTANCE = 6
+PHASH_MAX_DISTANCE = 10
+
+T = TypeVar("T")
+
+# ---------------------------------------------------------------------------
+# Hash functions
+# ---------------------------------------------------------------------------
+
+
+def _grey(img: np.ndarray) -> np.ndarray:
+    if img.ndim == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def dhash(img: np.ndarray) -> int:
+    """Return the 64-bit difference hash of *img*."""
+    small = cv2.resize(_grey(img), (9, 8), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def phash(img: np.ndarray) -> int:
+    """Return the 64-bit DCT hash of *img*."""
+    small = cv2.resize(_grey(img), (32, 32), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small.astype(np.float32))[:8, :8]
+    # The DC term only carries overall brightness, leave it out of the median.
+    return _bits_to_int(low > np.median(low.flatten()[1:]))
+
+
+def hash_file(path: Path | str) -> Optional[Tuple[int, int]]:
+    """Return ``(dhash, phash)`` of an image file, ``None`` if unreadable."""
+    img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    return dhash(img), phash(img)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def to_signed(h: int) -> int:
+    """Map an unsigned 64-bit hash onto SQLite's signed INTEGER range."""
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def to_unsigned(h: int) -> int:
+    return h + (1 << 64) if h < 0 else h
+
+
+# ---------------------------------------------------------------------------
+# Multi-index hashing
+# ---------------------------------------------------------------------------
+
+
+class MultiIndexHash(Generic[T]):
+    """Multi-index hashing over 64-bit hashes with Hamming distance.
+
+    Each hash is split into ``blocks`` substrings, every block keyed in its own
+    table.  Two hashes within distance ``r < blocks`` agree exactly on at
+    least one block (pigeonhole), so a search only verifies the entries that
+    share a block with the query.  Larger radii fall back to a full scan.
+    """
+
+    def __init__(self, *, blocks: int = 8, bits: int = 64) -> None:
+        self.blocks = blocks
+        self._width = -(-bits // blocks)
+        self._mask = (1 << self._width) - 1
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in range(blocks)]
+        self._hashes: List[int] = []
+        self._items: List[T] = []
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def __iter__(self) -> Iterator[Tuple[int, T]]:
+        return iter(list(zip(self._hashes, self._items)))
+
+    def add(self, h: int, item: T) -> None:
+        idx = len(self._hashes)
+        self._hashes.append(h)
+        self._items.append(item)
+        for table, key in zip(self._tables, self._keys(h)):
+            table.setdefault(key, []).append(idx)
+
+    def search(self, h: int, radius: int) -> List[Tuple[int, T]]:
+        """Return ``(distance, item)`` for every entry within *radius*."""
+        if radius >= self.blocks:
+            candidates: Iterable[int] = range(len(self._hashes))
+        else:
+            found: set = set()
+            for table, key in zip(self._tables, self._keys(h)):
+                found.update(table.get(key, ()))
+            candidates = found
+        out = []
+        for idx in candidates:
+            d = hamming(h, self._hashes[idx])
+            if d <= radius:
+                out.append((d, self._items[idx]))
+        return out
+
+    def _keys(self, h: int) -> List[int]:
+        return [(h >> (i * self._width)) & self._mask for i in range(self.blocks)]
+
+
+# ---------------------------------------------------------------------------
+# Duplicate index
+# ---------------------------------------------------------------------------
+
+
+class DuplicateIndex:
+    """In-memory multi-index hash over ``image_hash``, kept in step with the table.
+
+    Clusters for the default thresholds are kept as a union-find that is
+    built on the first ``clusters`` call and then extended as frames arrive;
+    other thresholds are computed on demand and cached until the next change.
+    """
+
+    _SELECT_HASHES = (
+        "SELECT h.image_id, i.fotoladu_id, h.dhash, h.phash "
+        "FROM image_hash h JOIN image i ON i.id = h.image_id"
+    )
+    _SELECT_NEWER = _SELECT_HASHES + " WHERE h.image_id > ?"
+    _COUNT = "SELECT count(*), coalesce(max(image_id), 0) FROM image_hash"
+    _SELECT_IMAGES = "SELECT id, fotoladu_id, peakaust, kaust, fail, path FROM image WHERE id IN ({})"
+
+    def __init__(self, *, db_path: Path | str) -> None:
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self._index: MultiIndexHash[Tuple[int, int, int]] = MultiIndexHash()
+        self._loaded = -1
+        self._max_id = 0
+        self._version = 0
+        # image_id -> parent, default thresholds; None until first needed
+        self._parent: Optional[Dict[int, int]] = None
+        self._cached: Dict[Tuple[int, int], Tuple[int, List[List[int]]]] = {}
+
+    # ---- Public API ----------------------------------------------------
+
+    def refresh(self, conn: sqlite3.Connection | None = None) -> None:
+        """Pick up rows added by other downloaders, threads or processes.
+
+        Cheap enough to call before every lookup: unchanged tables cost one
+        ``count(*)``, and rows appended with higher image ids are added in
+        place.  Anything else (e.g. a backfill of old ids) rebuilds the index.
+        """
+        own = conn is None
+        conn = conn or sqlite3.connect(self.db_path)
+        try:
+            with self._lock:
+                count, max_id = conn.execute(self._COUNT).fetchone()
+                if count == self._loaded:
+                    return
+                if 0 <= self._loaded < count:
+                    newer = conn.execute(self._SELECT_NEWER, (self._max_id,)).fetchall()
+                    if self._loaded + len(newer) == count:
+                        for image_id, fotoladu_id, dh, ph in newer:
+                            self._add_locked(image_id, fotoladu_id, to_unsigned(dh), to_unsigned(ph))
+                        self._loaded, self._max_id = count, max_id
+                        return
+                index: MultiIndexHash[Tuple[int, int, int]] = MultiIndexHash()
+                for image_id, fotoladu_id, dh, ph in conn.execute(self._SELECT_HASHES):
+                    index.add(to_unsigned(dh), (image_id, fotoladu_id, to_unsigned(ph)))
+                self._index, self._loaded, self._max_id = index, count, max_id
+                self._parent = None
+                self._version += 1
+        finally:
+            if own:
+                conn.close()
+
+    def add(self, image_id: int, fotoladu_id: int, hashes: Tuple[int, int]) -> None:
+        """Register a freshly inserted frame without reloading."""
+        with self._lock:
+            self._add_locked(image_id, fotoladu_id, hashes[0], hashes[1])
+            self._loaded += 1
+            self._max_id = max(self._max_id, image_id)
+
+    def find(
+        self,
+        hashes: Tuple[int, int],
+        *,
+        dhash_distance: int = DHASH_MAX_DISTANCE,
+        phash_distance: int = PHASH_MAX_DISTANCE,
+    ) -> List[Tuple[int, int]]:
+        """Return ``(image_id, fotoladu_id)`` of confirmed duplicates."""
+        dh, ph = hashes
+        return [
+            (image_id, fotoladu_id)
+            for _, (image_id, fotoladu_id, other_ph) in self._index.search(dh, dhash_distance)
+            if hamming(ph, other_ph) <= phash_distance
+        ]
+
+    def clusters(
+        self,
+        *,
+        dhash_distance: int = DHASH_MAX_DISTANCE,
+        phash_distance: int = PHASH_MAX_DISTANCE,
+    ) -> List[List[Dict[str, Any]]]:
+        """Group confirmed duplicates, largest cluster first."""
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            self.refresh(conn)
+            with self._lock:
+                groups = self._groups_locked(dhash_distance, phash_distance)
+
+            ids = [i for members in groups for i in members]
+            conn.row_factory = sqlite3.Row
+            rows: Dict[int, Dict[str, Any]] = {}
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                sql = self._SELECT_IMAGES.format(",".join("?" * len(chunk)))
+                rows.update({r["id"]: dict(r) for r in conn.execute(sql, chunk)})
+
+        out = [sorted((rows[i] for i in members if i in rows), key=lambda r: r["id"]) for members in groups]
+        return sorted(out, key=len, reverse=True)
+
+    # ---- Internal helpers ----------------------------------------------
+
+    def _add_locked(self, image_id: int, fotoladu_id: int, dh: int, ph: int) -> None:
+        self._index.add(dh, (image_id, fotoladu_id, ph))
+        self._version += 1
+        if self._parent is not None:
+            for other, _ in self.find((dh, ph)):
+                _union(self._parent, image_id, other)
+
+    def _groups_locked(self, dhash_distance: int, phash_distance: int) -> List[List[int]]:
+        default = (dhash_distance, phash_distance) == (DHASH_MAX_DISTANCE, PHASH_MAX_DISTANCE)
+        if default and self._parent is not None:
+            parent = self._parent
+        else:
+            cached = self._cached.get((dhash_distance, phash_distance))
+            if cached is not None and cached[0] == self._version:
+                return cached[1]
+            parent = {}
+            for dh, (image_id, _, ph) in self._index:
+                for other, _ in self.find((dh, ph), dhash_distance=dhash_distance, phash_distance=phash_distance):
+                    _union(parent, image_id, other)
+            if default:
+                self._parent = parent
+
+        groups: Dict[int, List[int]] = {}
+        for image_id in parent:
+            groups.setdefault(_root(parent, image_id), []).append(image_id)
+        result = [members for members in groups.values() if len(members) > 1]
+        if not default:
+            self._cached = {(dhash_distance, phash_distance): (self._version, result)}
+        return result
+
+
+def _root(parent: Dict[int, int], x: int) -> int:
+    while parent.setdefault(x, x) != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+def _union(parent: Dict[int, int], a: int, b: int) -> None:
+    if a != b:
+        parent[_root(parent, b)] = _root(parent, a)
@@ -38,6 +38,8 @@ import sqlite3
 import logging
 from typing import Any, Dict, List
 
+from src import metrics
+
 logger = logging.getLogger(__name__)
 
 # ---------------------------------------------------------------------------
@@ -140,9 +142,10 @@ class ImageLoader:
         # Open connection *inside* the calling thread
         with sqlite3.connect(self.db_path, check_same_thread=False) as conn:
             conn.row_factory = sqlite3.Row
-            rows = conn.execute(
-                "SELECT * FROM image ORDER BY RANDOM() LIMIT ?", (n,)
-            ).fetchall()
+            with metrics.SQLITE_SECONDS.time(component="image_loader", op="random"):
+                rows = conn.execute(
+                    "SELECT * FROM image ORDER BY RANDOM() LIMIT ?", (n,)
+                ).fetchall()
 
         result: List[Dict[str, Any]] = []
         for row in rows:
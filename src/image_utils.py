@@ -4,6 +4,12 @@ import cv2
 from pathlib import Path
 import numpy as np
 
+from src import metrics
+
+TONE_STAGE_SECONDS = metrics.histogram(
+    "tone_balance_stage_duration_seconds", "Per-stage timings of batch_tone_balance", ("stage",)
+)
+
 
 def crop_borders(img: np.ndarray) -> np.ndarray:
     """Crop scanner borders using the heuristic described in the README."""
@@ -106,27 +112,31 @@ def batch_tone_balance(
             return im[:, :, :3]
         return im
 
-    images = [_ensure_bgr(img) for img in images]
-    resized = [
-        cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA) for img in images
-    ]
+    with TONE_STAGE_SECONDS.time(stage="resize"):
+        images = [_ensure_bgr(img) for img in images]
+        resized = [
+            cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA) for img in images
+        ]
     # blurred = [cv2.GaussianBlur(im, (0, 0), sigmaX=15, sigmaY=15) for im in resized]
     blurred = resized
 
     #for idx, im in enumerate(blurred):
     #    print(f"  → image#{idx} shape = {im.shape}")
 
-    avg_img = np.mean(np.stack([im.astype(np.float32) for im in blurred]), axis=0)
-    avg_img_u8 = avg_img.astype(np.uint8)
+    with TONE_STAGE_SECONDS.time(stage="average"):
+        avg_img = np.mean(np.stack([im.astype(np.float32) for im in blurred]), axis=0)
+        avg_img_u8 = avg_img.astype(np.uint8)
 
     if save_avg is not None:
-        save_avg.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(save_avg), avg_img_u8, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
+        with TONE_STAGE_SECONDS.time(stage="save"):
+            save_avg.parent.mkdir(parents=True, exist_ok=True)
+            cv2.imwrite(str(save_avg), avg_img_u8, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
 
     # Average the percentiles from individual images
-    percs = [np.percentile(im, [3, 50, 97], axis=(0, 1)) for im in blurred]
-    percs = np.stack(percs, axis=0)
-    mean_percs = percs.mean(axis=0)
+    with TONE_STAGE_SECONDS.time(stage="percentiles"):
+        percs = [np.percentile(im, [3, 50, 97], axis=(0, 1)) for im in blurred]
+        percs = np.stack(percs, axis=0)
+        mean_percs = percs.mean(axis=0)
 
     if mean_percs.ndim == 1:
         lows = np.array([mean_percs[0]])
@@ -136,11 +146,13 @@ def batch_tone_balance(
         lows, mids, highs = mean_percs[0], mean_percs[1], mean_percs[2]
         # lows, mids, highs = mean_percs[:, 0], mean_percs[:, 1], mean_percs[:, 2]
 
-    corrected = [_apply_levels(img, lows, mids, highs) for img in images]
+    with TONE_STAGE_SECONDS.time(stage="apply"):
+        corrected = [_apply_levels(img, lows, mids, highs) for img in images]
     
-    corrected_avg = _apply_levels(avg_img_u8, lows, mids, highs)
+        corrected_avg = _apply_levels(avg_img_u8, lows, mids, highs)
     if save_corrected_avg is not None:
-        save_corrected_avg.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(save_corrected_avg), corrected_avg, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
+        with TONE_STAGE_SECONDS.time(stage="save"):
+            save_corrected_avg.parent.mkdir(parents=True, exist_ok=True)
+            cv2.imwrite(str(save_corrected_avg), corrected_avg, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
 
     return corrected, corrected_avg, avg_img_u8
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+"""src/label_queue.py - leased work queue for the labeling UI.
+
+Every labeling client opens a *session* and leases small batches of untagged
+frames.  A leased frame is not handed to anyone else until the lease expires
+or its tags are submitted, so concurrent labelers never get the same frame.
+Each lease call also extends the session's still-open leases, acting as a
+heartbeat while the client works through its prefetch buffer.
+
+Candidate ids are prefetched server-side in bulk (one ``ORDER BY RANDOM()``
+query per ``pool_size`` frames instead of one per click) and checked again
+inside the leasing transaction, so a stale candidate is simply skipped.
+
+Tag states follow the development notes: ``true`` -> 1, ``false`` -> 0,
+``null`` -> NULL.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional
+
+from src import metrics
+from src.image_loader import _build_urls
+
+__all__ = [
+    "LabelQueue",
+    "LeaseConflict",
+]
+
+logger = logging.getLogger(__name__)
+
+LEASES = metrics.counter("label_leases_total", "Frames leased to labeling sessions")
+SUBMISSIONS = metrics.counter("label_submissions_total", "Tag submissions", ("outcome",))
+POOL_SIZE = metrics.gauge("label_candidate_pool_size", "Prefetched untagged candidate ids")
+
+
+class LeaseConflict(Exception):
+    """The frame is already tagged differently, or leased by another session."""
+
+
+class LabelQueue:
+    """Lease untagged frames to sessions; see module docstring."""
+
+    _DELETE_EXPIRED = "DELETE FROM label_lease WHERE expires_at < ?"
+    _RENEW = "UPDATE label_lease SET expires_at = ? WHERE session = ?"
+    _SELECT_CANDIDATES = (
+        "SELECT i.id FROM image i "
+        "WHERE NOT EXISTS (SELECT 1 FROM tag t WHERE t.image_id = i.id) "
+        "AND NOT EXISTS (SELECT 1 FROM label_lease l WHERE l.image_id = i.id) "
+        "ORDER BY RANDOM() LIMIT ?"
+    )
+    _INSERT_LEASE = (
+        "INSERT OR IGNORE INTO label_lease (image_id, session, expires_at) "
+        "SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM tag WHERE image_id = ?)"
+    )
+    _SELECT_IMAGES = "SELECT * FROM image WHERE id IN ({})"
+    _SELECT_LEASE = "SELECT session, expires_at FROM label_lease WHERE image_id = ?"
+    _SELECT_TAGS = "SELECT tag, state FROM tag WHERE image_id = ?"
+    _INSERT_TAG = "INSERT INTO tag (image_id, tag, state) VALUES (?,?,?)"
+    _DELETE_LEASE = "DELETE FROM label_lease WHERE image_id = ? AND session = ?"
+    _RELEASE = "DELETE FROM label_lease WHERE session = ?"
+
+    def __init__(
+        self,
+        *,
+        db_path: Path | str,
+        lease_seconds: float = 600.0,
+        pool_size: int = 200,
+    ) -> None:
+        self.db_path = Path(db_path)
+        self.lease_seconds = lease_seconds
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._pool: Deque[int] = deque()
+
+    # ---- Public API ----------------------------------------------------
+
+    @staticmethod
+    def new_session() -> str:
+        return uuid.uuid4().hex
+
+    def lease(self, session: str, n: int = 5) -> List[Dict[str, Any]]:
+        """Lease up to *n* untagged frames to *session*, URLs resolved."""
+        n = max(1, min(n, 50))
+        now = time.time()
+        expires = now + self.lease_seconds
+        leased: List[int] = []
+        # The lock keeps threads of this process from racing for the same
+        # candidates; BEGIN IMMEDIATE does the same across processes.
+        with self._lock, closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(self._DELETE_EXPIRED, (now,))
+            conn.execute(self._RENEW, (expires, session))
+            for refilled in (False, True):
+                while len(leased) < n and self._pool:
+                    image_id = self._pool.popleft()
+                    if conn.execute(self._INSERT_LEASE, (image_id, session, expires, image_id)).rowcount:
+                        leased.append(image_id)
+                if len(leased) >= n or refilled:
+                    break
+                self._pool.extend(
+                    r[0] for r in conn.execute(self._SELECT_CANDIDATES, (max(self.pool_size, n),))
+                )
+            conn.commit()
+            POOL_SIZE.set(len(self._pool))
+            rows = self._images(conn, leased)
+
+        LEASES.inc(len(rows))
+        for row in rows:
+            row.update(_build_urls(row["path"]))
+            row["lease_expires_at"] = expires
+        return rows
+
+    def submit(self, session: str, image_id: int, tags: Dict[str, Optional[bool]]) -> None:
+        """Store *tags* for *image_id* and close the session's lease.
+
+        Resubmitting tags that are already stored (a retried request) is a
+        no-op.  Raises ``LeaseConflict`` if the frame already carries other
+        tags, or if another session holds a live lease on it.
+        """
+        rows = [(image_id, tag, None if state is None else int(bool(state))) for tag, state in tags.items()]
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            holder = conn.execute(self._SELECT_LEASE, (image_id,)).fetchone()
+            stored = {(r["tag"], r["state"]) for r in conn.execute(self._SELECT_TAGS, (image_id,))}
+            if stored:
+                conn.rollback()
+                if stored == {(tag, state) for _, tag, state in rows}:
+                    SUBMISSIONS.inc(outcome="repeated")
+                    return
+                SUBMISSIONS.inc(outcome="conflict")
+                raise LeaseConflict(f"image {image_id} is already tagged")
+            if holder is not None and holder["session"] != session and holder["expires_at"] >= time.time():
+                conn.rollback()
+                SUBMISSIONS.inc(outcome="conflict")
+                raise LeaseConflict(f"image {image_id} is leased by another session")
+            conn.executemany(self._INSERT_TAG, rows)
+            conn.execute(self._DELETE_LEASE, (image_id, session))
+            conn.commit()
+        SUBMISSIONS.inc(outcome="stored")
+
+    def release(self, session: str) -> int:
+        """Return every frame leased by *session* to the pool."""
+        with closing(self._connect()) as conn:
+            released = conn.execute(self._RELEASE, (session,)).rowcount
+            conn.commit()
+        return released
+
+    # ---- Internal helpers ----------------------------------------------
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: transactions are opened explicitly above.
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _images(self, conn: sqlite3.Connection, ids: List[int]) -> List[Dict[str, Any]]:
+        if not ids:
+            return []
+        rows = conn.execute(self._SELECT_IMAGES.format(",".join("?" * len(ids))), ids).fetchall()
+        by_id = {r["id"]: dict(r) for r in rows}
+        return [by_id[i] for i in ids if i in by_id]
@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+"""src/rate_control.py - shared adaptive rate controller for Fotoladu calls.
+
+Every upstream request (search pages, GeoJSON, image files) goes through one
+``UpstreamController`` so that all crawls running in the process together
+respect a single budget:
+
+* **Token bucket** - requests wait for a token; the refill rate is the
+  current allowed requests/second.
+* **AIMD** - the rate grows additively while responses are fast and clean and
+  is cut multiplicatively on 429/5xx, connection errors or when the smoothed
+  latency of an endpoint exceeds ``target_latency``.  Latency is tracked per
+  endpoint; image transfers take as long as their size demands, so they only
+  feed status and error signals.
+* **Retry-After / backoff** - 429 and 5xx responses are retried with full
+  jitter exponential backoff; a ``Retry-After`` header pauses *all* callers.
+* **Circuit breaker** - after ``failure_threshold`` consecutive failures the
+  circuit opens and calls fail fast with ``CircuitOpenError`` until
+  ``reset_timeout`` has passed; then a single trial request is let through.
+  Batch jobs set ``wait_when_open`` so their calls sleep through an open
+  circuit instead of failing every remaining item.
+"""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import requests
+
+from src import metrics
+
+__all__ = [
+    "CircuitOpenError",
+    "UpstreamController",
+]
+
+logger = logging.getLogger("uvicorn.error")
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Endpoints whose duration reflects payload size rather than server load.
+LATENCY_EXEMPT = frozenset({"image"})
+
+UPSTREAM_SECONDS = metrics.histogram(
+    "fotoladu_upstream_duration_seconds", "Latency of Fotoladu requests", ("endpoint", "status")
+)
+UPSTREAM_RETRIES = metrics.counter(
+    "fotoladu_upstream_retries_total", "Retried Fotoladu requests", ("endpoint", "reason")
+)
+UPSTREAM_RATE = metrics.gauge("fotoladu_upstream_rate_rps", "Allowed Fotoladu requests per second")
+CIRCUIT_OPEN = metrics.gauge("fotoladu_upstream_circuit_open", "1 while the circuit breaker is open")
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling Fotoladu while the circuit is open."""
+
+
+class UpstreamController:
+    """Thread-safe token bucket + AIMD + retry + circuit breaker."""
+
+    def __init__(
+        self,
+        *,
+        rate: float = 4.0,
+        min_rate: float = 0.25,
+        max_rate: float = 20.0,
+        burst: float = 4.0,
+        increase: float = 0.5,
+        decrease: float = 0.5,
+        target_latency: float = 2.0,
+        max_retries: int = 4,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+        failure_threshold: int = 8,
+        reset_timeout: float = 60.0,
+        connect_timeout: float = 10.0,
+        wait_when_open: bool = False,
+        session: requests.Session | None = None,
+    ) -> None:
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.connect_timeout = connect_timeout
+        self.wait_when_open = wait_when_open
+        # One pooled session keeps TCP/TLS connections alive between calls.
+        self.session = session or requests.Session()
+
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._latency: Dict[str, float] = {}  # endpoint -> EWMA, seconds
+        self._last_decrease = 0.0
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        UPSTREAM_RATE.set(rate)
+
+    # ---- Public API ----------------------------------------------------
+
+    def get(self, url: str, *, endpoint: str, timeout: float = 30.0, **kwargs: Any) -> requests.Response:
+        """``GET`` *url* under rate control, retrying transient failures.
+
+        Returns the final response (which may still be an error status once
+        retries are exhausted, callers use ``raise_for_status``).  Network
+        errors are re-raised after the last retry.
+        """
+        attempt = 0
+        while True:
+            self._before_request()
+            start = time.monotonic()
+            status = "error"
+            try:
+                resp = self.session.get(url, timeout=(self.connect_timeout, timeout), **kwargs)
+                status = str(resp.status_code)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                elapsed = time.monotonic() - start
+                self._on_failure(endpoint, elapsed)
+                if attempt >= self.max_retries:
+                    raise
+                UPSTREAM_RETRIES.inc(endpoint=endpoint, reason=type(err).__name__)
+                self._sleep_backoff(attempt, None)
+                attempt += 1
+                continue
+            except requests.RequestException:
+                self._on_failure(endpoint, time.monotonic() - start)
+                raise
+            finally:
+                UPSTREAM_SECONDS.observe(time.monotonic() - start, endpoint=endpoint, status=status)
+
+            elapsed = time.monotonic() - start
+            if resp.status_code not in RETRY_STATUSES:
+                self._on_success(endpoint, elapsed)
+                return resp
+
+            self._on_failure(endpoint, elapsed)
+            retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+            if retry_after is not None:
+                with self._lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            if attempt >= self.max_retries:
+                return resp
+            UPSTREAM_RETRIES.inc(endpoint=endpoint, reason=str(resp.status_code))
+            self._sleep_backoff(attempt, retry_after)
+            attempt += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "latency": dict(self._latency),
+                "failures": self._failures,
+                "circuit_open": self._opened_at is not None,
+            }
+
+    # ---- Internal helpers ----------------------------------------------
+
+    def _before_request(self) -> None:
+        """Check the breaker, honour Retry-After pauses and take a token."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = 0.0
+                if self._opened_at is not None:
+                    remaining = self.reset_timeout - (now - self._opened_at)
+                    if remaining > 0 or self._trial_running:
+                        if not self.wait_when_open:
+                            raise CircuitOpenError(
+                                f"Fotoladu circuit open after {self._failures} consecutive failures"
+                            )
+                        # Sleep until the trial is due (or has finished).
+                        wait = max(remaining, 1.0)
+                    else:
+                        # Half-open: let exactly one trial request through.
+                        self._trial_running = True
+
+                if not wait:
+                    self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+                    self._refilled_at = now
+                    wait = self._paused_until - now
+                    if wait <= 0:
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            return
+                        wait = (1 - self._tokens) / self.rate
+                    if self._trial_running:
+                        self._trial_running = False
+            time.sleep(wait)
+
+    def _on_success(self, endpoint: str, elapsed: float) -> None:
+        with self._lock:
+            latency = self._observe_latency(endpoint, elapsed)
+            self._failures = 0
+            if self._opened_at is not None:
+                logger.info("Fotoladu circuit closed")
+                self._opened_at = None
+                self._trial_running = False
+                CIRCUIT_OPEN.set(0)
+            if endpoint not in LATENCY_EXEMPT and latency > self.target_latency:
+                self._decrease_locked()
+            else:
+                # Additive increase of ~``increase`` rps per second of traffic.
+                self.rate = min(self.max_rate, self.rate + self.increase / max(self.rate, 1.0))
+            UPSTREAM_RATE.set(self.rate)
+
+    def _on_failure(self, endpoint: str, elapsed: float) -> None:
+        with self._lock:
+            self._observe_latency(endpoint, elapsed)
+            self._failures += 1
+            self._decrease_locked()
+            now = time.monotonic()
+            if self._opened_at is not None:
+                # Failed half-open trial: stay open for another period.
+                self._opened_at = now
+                self._trial_running = False
+            elif self._failures >= self.failure_threshold:
+                logger.warning(f"Fotoladu circuit opened after {self._failures} failures")
+                self._opened_at = now
+                CIRCUIT_OPEN.set(1)
+            UPSTREAM_RATE.set(self.rate)
+
+    def _observe_latency(self, endpoint: str, elapsed: float) -> float:
+        prev = self._latency.get(endpoint)
+        self._latency[endpoint] = elapsed if prev is None else 0.8 * prev + 0.2 * elapsed
+        return self._latency[endpoint]
+
+    def _decrease_locked(self) -> None:
+        # At most one multiplicative cut per second, so a burst of failures
+        # from parallel workers does not collapse the rate to the floor.
+        now = time.monotonic()
+        if now - self._last_decrease >= 1.0:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._last_decrease = now
+
+    def _sleep_backoff(self, attempt: int, retry_after: Optional[float]) -> None:
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        time.sleep(delay)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Return seconds from a ``Retry-After`` header (delta or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+"""src/region_crawler.py - adaptive quadtree crawl of large bounding boxes.
+
+``paring_db_arhiiv.php`` caps the number of features it returns, so a single
+query for a dense or large area is silently truncated.  ``RegionCrawler``
+splits the box into a quadtree instead:
+
+* a tile whose feature count reaches ``result_cap`` is split into four
+  children (down to ``max_depth``), otherwise its features are ingested;
+* tiles of one level are fetched concurrently (the shared upstream rate
+  controller keeps this polite);
+* features are deduplicated by fotoladu_id across tiles and against the DB
+  before ``FotoladuDownloader.ingest``;
+* tile state lives in ``crawl_tile``, so an interrupted crawl of the same box
+  resumes where it stopped; ``restart=True`` clears it to crawl a finished
+  box again.
+
+The real server cap is not documented; ``RESULT_CAP`` is a guess and can be
+overridden per crawl.  A root tile returning a round count below the cap is
+logged, as that usually means the cap is lower than assumed.
+
+Quadkeys are strings of ``0..3`` per level (``0`` = south-west,
+``1`` = south-east, ``2`` = north-west, ``3`` = north-east); the root tile
+is ``""``.
+
+```python
+crawler = RegionCrawler(FotoladuDownloader(db_path=DB_PATH))
+crawler.crawl(BBoxParams(aasta="1978", a_lat=57.5, a_lng=26.5, u_lat=58.1, u_lng=27.6))
+```
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List
+
+from src import metrics
+from src.downloader import BBoxParams, FotoladuDownloader
+
+__all__ = [
+    "RegionCrawler",
+    "tile_box",
+]
+
+logger = logging.getLogger("uvicorn.error")
+
+# Assumed feature cap of paring_db_arhiiv.php for one request; a tile
+# returning this many (or more) is treated as truncated and gets split.
+RESULT_CAP = 500
+
+CRAWL_TILES = metrics.counter("region_crawl_tiles_total", "Quadtree tiles processed", ("outcome",))
+
+
+def tile_box(root: BBoxParams, quadkey: str) -> BBoxParams:
+    """Return the bounding box of *quadkey* inside *root*."""
+    a_lat, a_lng, u_lat, u_lng = root.a_lat, root.a_lng, root.u_lat, root.u_lng
+    for q in quadkey:
+        mid_lat, mid_lng = (a_lat + u_lat) / 2, (a_lng + u_lng) / 2
+        if q in "01":
+            u_lat = mid_lat
+        else:
+            a_lat = mid_lat
+        if q in "02":
+            u_lng = mid_lng
+        else:
+            a_lng = mid_lng
+    return root.copy(update=dict(a_lat=a_lat, a_lng=a_lng, u_lat=u_lat, u_lng=u_lng))
+
+
+class RegionCrawler:
+    """Quadtree crawler on top of a ``FotoladuDownloader``.
+
+    Tile state is written on the calling thread through a connection of its
+    own; worker threads only fetch GeoJSON.
+    """
+
+    _SELECT_TILES = "SELECT quadkey, status FROM crawl_tile WHERE crawl = ?"
+    _UPSERT_TILE = "INSERT OR REPLACE INTO crawl_tile (crawl, quadkey, status, features) VALUES (?,?,?,?)"
+    _DELETE_TILES = "DELETE FROM crawl_tile WHERE crawl = ?"
+
+    def __init__(
+        self,
+        downloader: FotoladuDownloader,
+        *,
+        result_cap: int = RESULT_CAP,
+        max_depth: int = 8,
+        workers: int = 4,
+    ) -> None:
+        self.downloader = downloader
+        self.result_cap = result_cap
+        self.max_depth = max_depth
+        self.workers = workers
+
+    # ---- Public API ----------------------------------------------------
+
+    @staticmethod
+    def crawl_id(box: BBoxParams) -> str:
+        """Stable id of a crawl, derived from the root query."""
+        return hashlib.sha1(json.dumps(box.to_query(), sort_keys=True).encode()).hexdigest()[:16]
+
+    def crawl(self, box: BBoxParams, *, restart: bool = False) -> Dict[str, int]:
+        """Crawl *box* to completion (or resume a previous crawl of it).
+
+        ``restart`` forgets the stored tile state and crawls from the root.
+        """
+        crawl = self.crawl_id(box)
+        conn = sqlite3.connect(self.downloader.db_path, timeout=30)
+        try:
+            if restart:
+                conn.execute(self._DELETE_TILES, (crawl,))
+                conn.commit()
+            return self._crawl(box, crawl, conn)
+        finally:
+            conn.close()
+
+    # ---- Internal helpers ----------------------------------------------
+
+    def _crawl(self, box: BBoxParams, crawl: str, conn: sqlite3.Connection) -> Dict[str, int]:
+        tiles = dict(conn.execute(self._SELECT_TILES, (crawl,)).fetchall())
+        if not tiles:
+            conn.execute(self._UPSERT_TILE, (crawl, "", "pending", None))
+            conn.commit()
+            tiles = {"": "pending"}
+        elif any(status == "pending" for status in tiles.values()):
+            logger.info(f"Resuming crawl {crawl}")
+
+        stats = {"tiles": 0, "split": 0, "ingested": 0, "duplicates": 0}
+        seen: set = set()
+        pending = sorted(q for q, status in tiles.items() if status == "pending")
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending:
+                futures = {
+                    pool.submit(FotoladuDownloader.fetch_bbox, tile_box(box, q)): q for q in pending
+                }
+                pending = []
+                for fut in as_completed(futures):
+                    q = futures[fut]
+                    try:
+                        features = fut.result()
+                    except Exception as err:
+                        # Tile stays pending, a later crawl() retries it.
+                        logger.warning(f"Tile {q!r} of crawl {crawl} failed: {err}")
+                        CRAWL_TILES.inc(outcome="failed")
+                        continue
+                    stats["tiles"] += 1
+                    if q == "" and 0 < len(features) < self.result_cap and len(features) % 100 == 0:
+                        logger.warning(
+                            f"Root tile of crawl {crawl} returned exactly {len(features)} features; "
+                            f"the server cap may be lower than result_cap={self.result_cap}"
+                        )
+                    if len(features) >= self.result_cap and len(q) < self.max_depth:
+                        children = [q + c for c in "0123"]
+                        conn.executemany(
+                            self._UPSERT_TILE, [(crawl, c, "pending", None) for c in children]
+                        )
+                        conn.execute(self._UPSERT_TILE, (crawl, q, "split", len(features)))
+                        conn.commit()
+                        pending.extend(children)
+                        stats["split"] += 1
+                        CRAWL_TILES.inc(outcome="split")
+                        continue
+                    if len(features) >= self.result_cap:
+                        logger.warning(f"Tile {q!r} still capped at depth {len(q)}, results may be truncated")
+                    new = self._dedupe(features, seen)
+                    stats["duplicates"] += len(features) - len(new)
+                    try:
+                        self.downloader.ingest(new)
+                    except Exception as err:
+                        logger.warning(f"Ingest of tile {q!r} of crawl {crawl} failed: {err}")
+                        CRAWL_TILES.inc(outcome="failed")
+                        continue
+                    conn.execute(self._UPSERT_TILE, (crawl, q, "done", len(features)))
+                    conn.commit()
+                    stats["ingested"] += len(new)
+                    CRAWL_TILES.inc(outcome="done")
+        logger.info(f"Crawl {crawl} finished: {stats}")
+        return stats
+
+    def _dedupe(self, features: List[Dict[str, Any]], seen: set) -> List[Dict[str, Any]]:
+        """Drop features seen in earlier tiles of this run or already stored."""
+        unique: Dict[Any, Dict[str, Any]] = {}
+        for props in features:
+            fid = props.get("id")
+            if fid is not None and fid not in seen:
+                unique.setdefault(fid, props)
+        known = self.downloader.known_ids(list(unique))
+        seen.update(unique)
+        return [props for fid, props in unique.items() if fid not in known]
@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+"""src/tiles.py - DeepZoom tile pyramids for large scan variants.
+
+``hd`` (1920 px) and ``scan`` variants are too large to send whole to the
+labeling page.  ``TilePyramid`` cuts them into DeepZoom pyramids that a viewer
+such as OpenSeadragon loads tile by tile:
+
+* built **lazily** on the first request for an ``(image_id, variant)`` pair,
+  downloading the variant through the shared downloader if it is missing;
+  the source file is deleted once its pyramid is built, unless it is the
+  downloader's own variant, so only the size-bounded pyramid stays on disk;
+* cached under ``data/tiles/<image_id>/<variant>/`` in the DeepZoom layout
+  (``<level>/<col>_<row>.jpg``) next to an ``info.json`` with the size;
+* the cache is **size-bounded** - once it exceeds ``max_bytes`` the least
+  recently used pyramids are deleted, except those used within the last
+  ``EVICT_GRACE`` seconds, whose tiles may still be in flight.
+
+Level ``max_level`` is the full-resolution image, every level below halves
+it, down to 1x1 px at level 0.
+"""
+
+import json
+import logging
+import math
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import requests
+
+from src import metrics
+from src.downloader import FotoladuDownloader
+from src.rate_control import CircuitOpenError
+
+__all__ = [
+    "TilePyramid",
+    "TileSourceError",
+    "VARIANTS",
+]
+
+logger = logging.getLogger(__name__)
+
+TILES_DIR = Path("data/tiles")
+VARIANTS = ("reduced", "hd", "scan")
+TILE_SIZE = 256
+OVERLAP = 1
+JPEG_QUALITY = 85
+EVICT_GRACE = 60.0  # seconds
+
+TILE_CACHE = metrics.counter("tile_cache_total", "Tile pyramid lookups, miss = pyramid built", ("result",))
+TILE_BUILD_SECONDS = metrics.histogram(
+    "tile_pyramid_build_seconds", "Time to build one tile pyramid", ("variant",)
+)
+TILE_CACHE_BYTES = metrics.gauge("tile_cache_bytes", "Bytes used by cached tile pyramids")
+
+_DZI = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+    'Format="jpg" Overlap="{overlap}" TileSize="{tile_size}">'
+    '<Size Width="{w}" Height="{h}"/></Image>\n'
+)
+
+
+class TileSourceError(Exception):
+    """The source image of a pyramid could not be fetched or decoded."""
+
+
+class TilePyramid:
+    """Lazy DeepZoom pyramid builder with an LRU-evicted disk cache."""
+
+    _SELECT_IMAGE = "SELECT fotoladu_id, peakaust, kaust, fail FROM image WHERE id = ?"
+
+    def __init__(
+        self,
+        *,
+        db_path: Path | str,
+        downloader: FotoladuDownloader,
+        cache_dir: Path | str = TILES_DIR,
+        max_bytes: int = 2 * 1024**3,
+        tile_size: int = TILE_SIZE,
+        overlap: int = OVERLAP,
+    ) -> None:
+        self.db_path = Path(db_path)
+        self.downloader = downloader
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self._build_locks: Dict[Tuple[int, str], threading.Lock] = {}
+        # pyramid dir -> [size in bytes, last access]; None until scanned
+        self._usage: Optional[Dict[Path, list]] = None
+
+    # ---- Public API ----------------------------------------------------
+
+    def info(self, image_id: int, variant: str) -> Optional[Dict[str, Any]]:
+        """Return ``{"w", "h", "max_level", "bytes"}``, building on first use.
+
+        Returns ``None`` when the image id is unknown and raises
+        ``TileSourceError`` when the variant cannot be obtained.
+        """
+        if variant not in VARIANTS:
+            raise ValueError(f"unknown variant {variant!r}, expected one of {VARIANTS}")
+        root = self._root(image_id, variant)
+        info = self._read_info(root)
+        if info is None:
+            with self._build_lock(image_id, variant):
+                info = self._read_info(root)
+                if info is None:
+                    TILE_CACHE.inc(result="miss")
+                    info = self._build(image_id, variant, root)
+                    if info is None:
+                        return None
+                    self._account(root, info["bytes"])
+                    self._evict(keep=root)
+                    return info
+        TILE_CACHE.inc(result="hit")
+        self._touch(root)
+        return info
+
+    def descriptor(self, image_id: int, variant: str) -> Optional[str]:
+        """DeepZoom ``.dzi`` XML for the pyramid."""
+        info = self.info(image_id, variant)
+        if info is None:
+            return None
+        return _DZI.format(overlap=self.overlap, tile_size=self.tile_size, w=info["w"], h=info["h"])
+
+    def tile(self, image_id: int, variant: str, level: int, col: int, row: int) -> Optional[Path]:
+        """Path of one tile, or ``None`` if it lies outside the pyramid."""
+        info = self.info(image_id, variant)
+        if info is None or not 0 <= level <= info["max_level"]:
+            return None
+        path = self._root(image_id, variant) / str(level) / f"{col}_{row}.jpg"
+        return path if path.exists() else None
+
+    # ---- Building ------------------------------------------------------
+
+    def _build(self, image_id: int, variant: str, root: Path) -> Optional[Dict[str, Any]]:
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(self._SELECT_IMAGE, (image_id,)).fetchone()
+        if row is None:
+            return None
+        meta = dict(zip(("id", "peakaust", "kaust", "fail"), row))
+        try:
+            src = self.downloader.fetch_variant(meta, variant)
+        except (requests.RequestException, CircuitOpenError) as err:
+            raise TileSourceError(f"cannot fetch {variant} of image {image_id}: {err}") from err
+        img = cv2.imread(str(src), cv2.IMREAD_COLOR)
+        if variant != self.downloader.variant:
+            # Nothing else reads this copy; a rebuild after eviction re-downloads it.
+            src.unlink(missing_ok=True)
+        if img is None:
+            raise TileSourceError(f"cannot decode {variant} of image {image_id}: {src}")
+
+        start = time.perf_counter()
+        h, w = img.shape[:2]
+        max_level = math.ceil(math.log2(max(w, h, 1)))
+        tmp = root.with_name(root.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        total = 0
+        level_img = img
+        for level in range(max_level, -1, -1):
+            lh, lw = level_img.shape[:2]
+            level_dir = tmp / str(level)
+            level_dir.mkdir(parents=True, exist_ok=True)
+            for col in range(math.ceil(lw / self.tile_size)):
+                for row_ in range(math.ceil(lh / self.tile_size)):
+                    x0 = max(col * self.tile_size - self.overlap, 0)
+                    y0 = max(row_ * self.tile_size - self.overlap, 0)
+                    x1 = min((col + 1) * self.tile_size + self.overlap, lw)
+                    y1 = min((row_ + 1) * self.tile_size + self.overlap, lh)
+                    ok, buf = cv2.imencode(
+                        ".jpg", level_img[y0:y1, x0:x1], [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY]
+                    )
+                    (level_dir / f"{col}_{row_}.jpg").write_bytes(buf.tobytes())
+                    total += len(buf)
+            # Next level is half the size, rounded up (DeepZoom convention).
+            nw, nh = max(1, math.ceil(lw / 2)), max(1, math.ceil(lh / 2))
+            if level:
+                level_img = cv2.resize(level_img, (nw, nh), interpolation=cv2.INTER_AREA)
+
+        info = {"w": w, "h": h, "max_level": max_level, "bytes": total}
+        (tmp / "info.json").write_text(json.dumps(info))
+        # Publish atomically so readers never see a half-written pyramid.
+        shutil.rmtree(root, ignore_errors=True)
+        root.parent.mkdir(parents=True, exist_ok=True)
+        tmp.rename(root)
+        TILE_BUILD_SECONDS.observe(time.perf_counter() - start, variant=variant)
+        logger.info(f"Built {variant} pyramid for image {image_id}: {max_level + 1} levels, {total} bytes")
+        return info
+
+    # ---- Cache bookkeeping ---------------------------------------------
+
+    def _root(self, image_id: int, variant: str) -> Path:
+        return self.cache_dir / str(image_id) / variant
+
+    @staticmethod
+    def _read_info(root: Path) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads((root / "info.json").read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _build_lock(self, image_id: int, variant: str) -> threading.Lock:
+        with self._lock:
+            return self._build_locks.setdefault((image_id, variant), threading.Lock())
+
+    def _scan(self) -> Dict[Path, list]:
+        """Load sizes/access times of existing pyramids once per process."""
+        if self._usage is None:
+            usage: Dict[Path, list] = {}
+            for info_file in self.cache_dir.glob("*/*/info.json"):
+                info = self._read_info(info_file.parent) or {}
+                usage[info_file.parent] = [info.get("bytes", 0), info_file.stat().st_mtime]
+            self._usage = usage
+            TILE_CACHE_BYTES.set(sum(u[0] for u in usage.values()))
+        return self._usage
+
+    def _account(self, root: Path, size: int) -> None:
+        with self._lock:
+            self._scan()[root] = [size, time.time()]
+            TILE_CACHE_BYTES.set(sum(u[0] for u in self._usage.values()))
+
+    def _touch(self, root: Path) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self._scan().get(root)
+            if entry is None:
+                return
+            # info.json mtime persists LRU order across restarts; refresh it
+            # at most once a minute to keep tile requests cheap.
+            if now - entry[1] > 60:
+                try:
+                    (root / "info.json").touch()
+                except FileNotFoundError:
+                    pass
+            entry[1] = now
+
+    def _evict(self, *, keep: Path) -> None:
+        with self._lock:
+            usage = self._scan()
+            total = sum(u[0] for u in usage.values())
+            recent = time.time() - EVICT_GRACE
+            for root, (size, used_at) in sorted(usage.items(), key=lambda kv: kv[1][1]):
+                if total <= self.max_bytes or used_at > recent:
+                    # Sorted by last use: everything after this is recent too.
+                    break
+                if root == keep:
+                    continue
+                shutil.rmtree(root, ignore_errors=True)
+                del usage[root]
+                total -= size
+                logger.debug(f"Evicted tile pyramid {root}")
+            TILE_CACHE_BYTES.set(total)
@@ -1,28 +1,114 @@
-async function loadRandomImage() {
-    const response = await fetch('/api/random?count=1');
-    if (!response.ok) {
-        console.error('Failed to fetch image');
+// Labeling session: frames are leased in batches and decoded ahead of time,
+// so showing the next frame after a submit does not wait for the network.
+const BUFFER_TARGET = 5;   // frames kept leased and decoded
+const REFILL_BELOW = 3;    // lease more when the buffer drops under this
+
+let session = null;
+let current = null;
+const buffer = [];
+let refilling = null;
+
+async function openSession() {
+    const response = await fetch('/api/session', { method: 'POST' });
+    if (!response.ok) throw new Error('Failed to open labeling session');
+    session = (await response.json()).session;
+}
+
+function decode(url) {
+    // Resolve once the browser has the image decoded (or failed to load it)
+    if (!url) return Promise.resolve();
+    const img = new Image();
+    img.src = url;
+    return img.decode().catch(() => {});
+}
+
+function refillBuffer() {
+    if (refilling || buffer.length >= REFILL_BELOW) return refilling;
+    const count = BUFFER_TARGET - buffer.length;
+    refilling = (async () => {
+        try {
+            const response = await fetch(`/api/session/${session}/lease?count=${count}`, { method: 'POST' });
+            if (!response.ok) {
+                console.error('Failed to lease images');
+                return;
+            }
+            for (const data of await response.json()) {
+                data.ready = Promise.all([decode(data.url), decode(data.url_raw)]);
+                buffer.push(data);
+            }
+        } finally {
+            refilling = null;
+        }
+    })();
+    return refilling;
+}
+
+async function showNextImage() {
+    if (!buffer.length) await refillBuffer();
+    const data = buffer.shift();
+    refillBuffer();
+    if (!data) {
+        console.error('No untagged images left');
         return;
     }
-    let data = await response.json();
-    data = data[0]
+    await data.ready;
+    current = data;
     document.getElementById('photo-fix').src = data.url;
     if (data.url_raw) document.getElementById('photo-raw').src = data.url_raw;
     else document.getElementById('photo-raw').src = '#"'
     document.getElementById('overlay-id').innerText = data.fotoladu_id;
     document.getElementById('open-in-FL').href = `https://fotoladu.maaamet.ee/arhiiv=${data.fotoladu_id}`;
 
+    document.getElementById('tag-form').reset();
     populateTable(data);
     window.location.hash = `#${data.id}`;
+    await loadPrediction(data.id);
+}
+
+function submitTags(imageId) {
+    // Fire and forget: the next frame is shown without waiting for the write
+    const tags = {};
+    document.querySelectorAll('#tag-form .form-check-input').forEach((el) => {
+        tags[el.value] = el.checked;
+    });
+    fetch(`/api/session/${session}/tags`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ image_id: imageId, tags }),
+    })
+        .then((r) => r.json())
+        .then((r) => { if (r.error) console.warn(r.error); })
+        .catch((err) => console.error('Failed to submit tags', err));
+}
+
+async function loadPrediction(imageId) {
+    // Predicted position from georeferenced frames of the same flight
+    const cell = document.getElementById('predicted-location');
+    const response = await fetch(`/api/predict/${imageId}`);
+    if (!response.ok || !cell) return;
+    const p = await response.json();
+    if (p.error) {
+        cell.innerText = '-';
+        return;
+    }
+    cell.innerText = `${p.lat.toFixed(5)}, ${p.lon.toFixed(5)} (${p.method}, ${p.gap} frames)`;
 }
 
 document.getElementById('tag-form').addEventListener('submit', async (e) => {
     e.preventDefault();
-    // Placeholder for submitting tags
-    await loadRandomImage();
+    if (current) submitTags(current.id);
+    await showNextImage();
+});
+
+window.addEventListener('load', async () => {
+    await openSession();
+    await showNextImage();
 });
 
-window.addEventListener('load', loadRandomImage);
+// Hand unfinished frames back to the pool when the tab is closed
+window.addEventListener('pagehide', () => {
+    if (session) navigator.sendBeacon(`/api/session/${session}/release`);
+});
 
 function populateTable(data) {
     // build a small HTML table of metadata
@@ -41,6 +127,7 @@ function populateTable(data) {
        <tr><th scope="row">Map sheet</th><td>${data.kaardileht}</td></tr>
        <tr><th scope="row">Type</th><td>${data.tyyp}</td></tr>
        <tr><th scope="row">Source</th><td>${data.allikas}</td></tr>
+       <tr><th scope="row">Predicted location</th><td id="predicted-location">…</td></tr>
        <tr><th scope="row">Thumb URL</th>
            <td><a href="${data.url_thumb}" target="_blank">${data.url_thumb}</a></td>
        </tr>